@@ -1,22 +1,25 @@
-import boto3
 import streamlit as st
-import pandas as pd
-from io import StringIO
-import plotly.express as px
 
-from utils import BUCKET_NAME, read_csv_from_s3
+from charts import get_figure, year_months
+from storage import get_storage_client
+from tenancy import authenticate, current_tenant, select_year, start_tenant_session, tenant_keys, years_of
+from utils import BUCKET_NAME, display_transactions_explorer
+from output_store import UNKNOWN_MONTH, is_empty, list_months, read_manifest
+from query import categoryDistributionSql, monthlySummarySql, query_transactions
+from tracing import count, display_trace_panel, span, start_trace
 
 st.set_page_config(page_title="Trend", page_icon=":moneybag:", layout="wide")
+start_trace('app')
 st.markdown("# Sommaire")
 st.sidebar.header("Accueil")
 
-import hmac
-
 def check_password():
     """Returns `True` if the user had the correct password."""
     def password_entered():
-        """Checks whether a password entered by the user is correct."""
-        if hmac.compare_digest(st.session_state["password"], st.secrets["credentials"]["password"]):
+        """Checks whether a password entered by the user is correct, and attaches the session to its tenant."""
+        tenant = authenticate(st.session_state["password"])
+        if tenant is not None:
+            start_tenant_session(tenant)
             st.session_state["password_correct"] = True
             del st.session_state["password"]  # Don't store the password.
         else:
@@ -44,39 +47,56 @@ is_prod = True if st.secrets["env"]["production_env"] == "1" else False
 
 
 ENV_FOLDER = 'prod' if is_prod else 'local'
-FILE_KEY_OUTPUT = '/output/combined_transactions.csv'
-FILE_KEY_BUDGET = 'shared/budget_2025.xlsx'
+# storage keys of the household of the session
+FILE_KEY_OUTPUT = tenant_keys(ENV_FOLDER, current_tenant())['output']
 
-# Initialize a session using Amazon S3
-s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+# Get the storage client shared by all sessions (S3, or the local/memory backend)
+s3 = get_storage_client(aws_access_key_id, aws_secret_access_key)
 
-# Load output data
-body_output = read_csv_from_s3(s3, BUCKET_NAME, ENV_FOLDER+FILE_KEY_OUTPUT)
-if body_output is None:
+# Read the manifest, its version keys the cached query results
+with span('read_manifest'):
+    manifest = read_manifest(s3, BUCKET_NAME, FILE_KEY_OUTPUT)
+if is_empty(manifest):
     st.error('No data available. Please import transactions first.')
     st.stop()
 
+# The summary and the charts are of the selected year
+months = [month for month in list_months(manifest) if month != UNKNOWN_MONTH]
+year = select_year(years_of(months))
+months = tuple(year_months(manifest, year))
+if not months:
+    st.warning(f'No transactions in {year}.')
+    st.stop()
+
 
+def query(sql, params=(), months=None):
+    # aggregation over the stored transactions, only the given months are scanned
+    count('queries')
+    with span('query'):
+        return query_transactions(s3, BUCKET_NAME, FILE_KEY_OUTPUT, manifest, manifest['version'],
+                                  sql, params, months)
 
-df_output = pd.read_csv(StringIO(body_output), index_col=False)
-# Ensure the Date column is in datetime format
-df_output['Date'] = pd.to_datetime(df_output['Date'], errors='coerce')
 
+def figure(kind, month=None, category=None):
+    # built once per data version, year, month and category, shared by the sessions of the tenant
+    return get_figure(kind, s3, BUCKET_NAME, FILE_KEY_OUTPUT, manifest, month, category, year)
 
-# Create a bar chart showing expenses and credit for each month
-df_output['Month'] = df_output['Date'].dt.to_period('M').astype(str)  # Convert Period to string
-monthly_summary = df_output.groupby(['Month', 'Type'])['Amount'].sum().reset_index()
-fig_summary = px.bar(monthly_summary, x='Month', y='Amount', color='Type', barmode='group', title='Revenus vs Depenses par mois')
+
+# Create a bar chart showing expenses and credit for each month of the year
+monthly_summary = query(monthlySummarySql, months=months)
+with span('render.summary_figure'):
+    fig_summary = figure('summary')
 
 
 # display side by side on nice box values for the total expenses and total credits for the current month
-current_month = df_output['Month'].max()
-total_expenses = df_output[(df_output['Type'] == 'expense') & (df_output['Month'] == current_month)]['Amount'].sum()
-total_credits = df_output[(df_output['Type'] == 'credit') & (df_output['Month'] == current_month)]['Amount'].sum()
+current_month = monthly_summary['Month'].max()
+current_month_totals = monthly_summary[monthly_summary['Month'] == current_month]
+total_expenses = current_month_totals[current_month_totals['Type'] == 'expense']['Amount'].sum()
+total_credits = current_month_totals[current_month_totals['Type'] == 'credit']['Amount'].sum()
 
 
 # show in a table the total expenses and total credits for the current month
-current_month_summary = df_output[df_output['Month'] == current_month].pivot_table(columns='Type', values='Amount', aggfunc='sum').reset_index(drop=True)
+current_month_summary = current_month_totals.pivot_table(columns='Type', values='Amount', aggfunc='sum').reset_index(drop=True)
 
 col1, col2 = st.columns((1,2))
 with col1:
@@ -88,7 +108,7 @@ with col1:
     else:
         st.warning("Pas de donnees dispo pour ce mois")
 
-with col2:
+with col2, span('render.summary_chart'):
     st.plotly_chart(fig_summary)
 
 
@@ -97,25 +117,24 @@ with col2:
 col1, col2 = st.columns(2)
 with col1:
     # Filter by month and year
-    selected_month = st.selectbox('Select a Month', df_output['Month'].unique())
-    filtered_data = df_output[df_output['Month'] == selected_month]
+    selected_month = st.selectbox('Select a Month', monthly_summary['Month'].unique())
     # Create a bar chart for expense distribution by category
-    category_distribution = filtered_data[filtered_data['Type'] == 'expense'].groupby('Category')[
-        'Amount'].sum().reset_index().sort_values(by='Amount', ascending=True)
-    fig_category = px.bar(category_distribution, x='Amount', y='Category', orientation='h',
-                          title='Expense Distribution by Category')
-    st.plotly_chart(fig_category)
+    category_distribution = query(categoryDistributionSql, (selected_month,), (selected_month,))
+    with span('render.category_chart'):
+        fig_category = figure('category', selected_month)
+        st.plotly_chart(fig_category)
 with col2:
     # Create a bar chart for sub-category distribution within a selected category
     selected_category = st.selectbox('Select a Category', category_distribution['Category'].unique())
-    sub_category_distribution = \
-    filtered_data[(filtered_data['Type'] == 'expense') & (filtered_data['Category'] == selected_category)].groupby(
-        'Sub Category')['Amount'].sum().reset_index()
-    fig_sub_category = px.bar(sub_category_distribution, x='Sub Category', y='Amount',
-                              title=f'Expense Distribution in {selected_category}')
-    st.plotly_chart(fig_sub_category)
+    with span('render.sub_category_chart'):
+        fig_sub_category = figure('sub_category', selected_month, selected_category)
+        st.plotly_chart(fig_sub_category)
 
 
-# Display the data in Streamlit
+# Display the transactions, filtered and paginated on the server
 st.title('Transactions consolidées')
-st.dataframe(df_output)
\ No newline at end of file
+with span('render.explorer'):
+    display_transactions_explorer(s3, BUCKET_NAME, FILE_KEY_OUTPUT, manifest)
+
+# End the trace of this rerun, and show the profiling panel when PERF_TRACE is set
+display_trace_panel()
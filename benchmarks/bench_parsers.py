@@ -0,0 +1,146 @@
+# Benchmark of the bank parsers on synthetic statements
+#
+# Usage: python benchmarks/bench_parsers.py [nb_rows ...]
+# Every parser runs on a synthetic statement of each size, and its output is checked
+# against the previous row-wise implementation kept below.
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import cleanedCol, listNBCCol, listNBCColCredit, listRBCCol, listScotiaCol, \
+    parse_bnc_credit_data, parse_bnc_data, parse_rbc_data, parse_scotia_data
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def legacy_parse_rbc_data(data):
+    data['Type de compte'] = data['Type de compte'].astype(
+        str).replace(to_replace='Chèques', value='Checking')
+    data['Type de compte'] = data['Type de compte'].astype(
+        str).replace(to_replace='MasterCard', value='Credit Card')
+    data = data.rename(columns={'Type de compte': 'Account'})
+    data = data.rename(columns={"Date de l'opération": 'Date'})
+    data['Date'] = pd.to_datetime(data['Date'], format='%m/%d/%Y').dt.strftime('%Y-%m-%d')
+    data['Description'] = data.apply(
+        lambda row: ' / '.join(filter(pd.notna, [row['Description 1'], row['Description 2']])), axis=1)
+    data = data.rename(columns={"CAD": 'Amount'})
+    data['Type'] = data['Amount'].apply(
+        lambda x: 'expense' if x < 0 else 'credit')
+    data['Amount'] = data['Amount'].abs()
+    data['Name'] = 'RBC'
+    data['Category'] = ''
+    data['Sub Category'] = ''
+    data['To Ignore'] = False
+    return 100, data[cleanedCol]
+
+
+def legacy_parse_bnc_rows(data, account):
+    data['Debit'] = data['Debit'].astype(str).str.extract(r'(\d+[.]?\d*)', expand=True).astype(float)
+    data['Credit'] = data['Credit'].astype(str).str.extract(r'(\d+[.]?\d*)', expand=True).astype(float)
+    data['Amount'] = data['Debit'] + data['Credit']
+    data['Type'] = data['Debit'].apply(lambda x: 'expense' if x > 0 else 'credit')
+    data['Description'] = data['Description'].astype(str) + ' / ' + data['Categorie'].astype(str)
+    data['Account'] = account
+    data['Name'] = 'NBC'
+    data['Category'] = ''
+    data['Sub Category'] = ''
+    data['To Ignore'] = False
+    return 100, data[cleanedCol]
+
+
+def legacy_parse_scotia_data(data, type_account):
+    data['Type'] = data['Type d’opération'].apply(lambda x: 'expense' if x == 'Débit' else 'credit')
+    data['Description'] = data['Description'].astype(str) + ' / ' + data['Sous-description'].astype(str)
+    data['Amount'] = data['Montant'].astype(float).abs()
+    data['Account'] = type_account
+    data['Name'] = 'Scotia'
+    data['Category'] = ''
+    data['Sub Category'] = ''
+    data['To Ignore'] = False
+    return 100, data[cleanedCol]
+
+
+def with_missing(rng, values, ratio):
+    values = pd.Series(values, dtype=object)
+    return values.mask(rng.random(len(values)) < ratio)
+
+
+def synthetic_rbc(rng, nb_rows):
+    dates = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 5 * 365, nb_rows), unit='D')
+    return pd.DataFrame({
+        'Type de compte': rng.choice(['Chèques', 'MasterCard'], nb_rows),
+        'Numéro du compte': rng.integers(1_000_000, 9_999_999, nb_rows),
+        "Date de l'opération": dates.strftime('%m/%d/%Y'),
+        'Numéro du chèque': np.nan,
+        'Description 1': with_missing(rng, rng.choice(['IGA', 'SAQ', 'Hydro', 'Paie'], nb_rows), 0.05),
+        'Description 2': with_missing(rng, rng.choice(['#123', 'Montreal', 'Web'], nb_rows), 0.6),
+        'CAD': rng.normal(0, 200, nb_rows).round(2),
+        'USD': np.nan,
+    }, columns=listRBCCol)
+
+
+def synthetic_bnc(rng, nb_rows, list_col):
+    dates = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 5 * 365, nb_rows), unit='D')
+    is_debit = rng.random(nb_rows) < 0.8
+    amounts = rng.uniform(1, 500, nb_rows).round(2)
+    return pd.DataFrame({
+        'Date': dates.strftime('%Y-%m-%d'),
+        'Numero de Carte': '5191********2110',
+        'Description': rng.choice(['Metro', 'Esso', 'Virement', 'Netflix'], nb_rows),
+        'Categorie': rng.choice(['Epicerie', 'Essence', 'Divers'], nb_rows),
+        'Debit': np.where(is_debit, amounts, 0.0),
+        'Credit': np.where(is_debit, 0.0, amounts),
+        'Solde': rng.uniform(0, 5000, nb_rows).round(2),
+    })[list_col]
+
+
+def synthetic_scotia(rng, nb_rows):
+    dates = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 5 * 365, nb_rows), unit='D')
+    return pd.DataFrame({
+        'Filtre': '',
+        'Date': dates.strftime('%Y-%m-%d'),
+        'Description': rng.choice(['Costco', 'Bell', 'Depot'], nb_rows),
+        'Sous-description': rng.choice(['Achat', 'Paiement'], nb_rows),
+        'Type d’opération': rng.choice(['Débit', 'Crédit'], nb_rows),
+        'Montant': rng.normal(0, 150, nb_rows).round(2),
+        'Solde': rng.uniform(0, 5000, nb_rows).round(2),
+    }, columns=listScotiaCol)
+
+
+PARSERS = [
+    ('RBC', synthetic_rbc, parse_rbc_data, legacy_parse_rbc_data),
+    ('NBC Cheque', lambda rng, n: synthetic_bnc(rng, n, listNBCCol), parse_bnc_data,
+     lambda df: legacy_parse_bnc_rows(df, 'Checking')),
+    ('NBC Credit', lambda rng, n: synthetic_bnc(rng, n, listNBCColCredit), parse_bnc_credit_data,
+     lambda df: legacy_parse_bnc_rows(df, 'Credit Card')),
+    ('Scotia', synthetic_scotia, lambda df: parse_scotia_data(df, 'Checking'),
+     lambda df: legacy_parse_scotia_data(df, 'Checking')),
+]
+
+
+def timed(parser, df):
+    start = time.perf_counter()
+    ret, parsed = parser(df.copy())
+    return time.perf_counter() - start, ret, parsed
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    rng = np.random.default_rng(42)
+
+    print(f"{'parser':<12}{'rows':>10}{'legacy (s)':>12}{'current (s)':>13}{'speedup':>9}")
+    for name, make_statement, parser, legacy_parser in PARSERS:
+        for nb_rows in sizes:
+            df = make_statement(rng, nb_rows)
+            legacy_time, _, expected = timed(legacy_parser, df)
+            current_time, ret, parsed = timed(parser, df)
+            if ret != 100:
+                sys.exit(f"{name} parser returned {ret}")
+            pd.testing.assert_frame_equal(parsed, expected)
+            print(f"{name:<12}{nb_rows:>10}{legacy_time:>12.3f}{current_time:>13.3f}"
+                  f"{legacy_time / current_time:>8.1f}x")
@@ -0,0 +1,174 @@
+# End to end benchmark of the import, save and dashboard pipeline, fully offline
+#
+# Usage: python benchmarks/bench_pipeline.py [nb_rows ...] [--output results.json] [--baseline baseline.json]
+# For every size, a synthetic RBC export is imported (staged and parsed), saved to the output
+# store and compacted, then the dashboard is loaded (first page of the transactions explorer,
+# cold and warm local cache) and aggregated with the queries of app.py, against a
+# filesystem-backed S3 stand-in (see local_s3.py).
+# Every size runs in its own process, so the peak RSS of a stage is the high-water mark of
+# that process after the stage. The results are written as JSON, and compared with a
+# previous run with --baseline.
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+BUCKET = 'benchmark'
+STAGING_KEY = 'local/staging/rbc_checking.csv'
+OUTPUT_PREFIX = 'local/output/transactions/'
+INCREMENT_ROWS = 1_000
+CATEGORIES = {'Maison': ['Loyer', 'Hydro'], 'Auto': ['Essence', 'Assurance'], 'Epicerie': ['Epicerie - Autre']}
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def categorize(rng, df):
+    df = df.copy()
+    categories = list(CATEGORIES)
+    df['Category'] = rng.choice(categories, len(df))
+    df['Sub Category'] = [CATEGORIES[category][i % len(CATEGORIES[category])]
+                          for i, category in enumerate(df['Category'])]
+    return df
+
+
+def aggregate(s3, manifest):
+    """
+    Run the aggregations of app.py on the loaded data.
+    """
+    import plotly.express as px
+
+    from query import categoryDistributionSql, monthlySummarySql, query_transactions, subCategoryDistributionSql
+
+    def query(sql, params=(), months=None):
+        return query_transactions(s3, BUCKET, OUTPUT_PREFIX, manifest, manifest['version'], sql, params, months)
+
+    monthly_summary = query(monthlySummarySql)
+    px.bar(monthly_summary, x='Month', y='Amount', color='Type', barmode='group')
+    current_month = monthly_summary['Month'].max()
+    current_month_totals = monthly_summary[monthly_summary['Month'] == current_month]
+    current_month_totals.pivot_table(columns='Type', values='Amount', aggfunc='sum')
+    for month in monthly_summary['Month'].unique():
+        category_distribution = query(categoryDistributionSql, (month,), (month,))
+        px.bar(category_distribution, x='Amount', y='Category', orientation='h')
+        for category in category_distribution['Category']:
+            query(subCategoryDistributionSql, (month, category), (month,))
+
+
+def run_size(nb_rows, root):
+    """
+    Run every stage of the pipeline on a history of nb_rows transactions.
+
+    Returns:
+    dict: The seconds, requests, bytes transferred and peak RSS of every stage.
+    """
+    import output_store
+    from bench_parsers import synthetic_rbc
+    from local_s3 import LocalS3Client
+    import duckdb
+
+    from output_store import append_output_data, compact_output, list_months, read_manifest
+    from query import explorer_filter, explorer_page_sql, register_transactions
+    from utils import CHUNK_SIZE, PAGE_SIZES, accountFormats, ingest_chunks, parse_rbc_data
+
+    # compaction is timed as its own stage, not in the background of the save
+    output_store.COMPACT_MAX_SEGMENTS = output_store.COMPACT_MAX_SEGMENT_ROWS = float('inf')
+
+    rng = np.random.default_rng(42)
+    s3 = LocalS3Client(root)
+    list_col, sep = accountFormats['RBC']
+    export = synthetic_rbc(rng, nb_rows).to_csv(index=False).encode('utf-8')
+    increment = categorize(rng, parse_rbc_data(synthetic_rbc(rng, INCREMENT_ROWS))[1])
+    results = {}
+
+    def stage(name, func):
+        s3.reset_stats()
+        start = time.perf_counter()
+        out = func()
+        results[name] = {'seconds': time.perf_counter() - start, **s3.stats, 'peak_rss': peak_rss()}
+        return out
+
+    def import_export():
+        chunks = pd.read_csv(BytesIO(export), names=list_col, index_col=False, sep=sep, skiprows=1,
+                             chunksize=CHUNK_SIZE)
+        return ingest_chunks(chunks, parse_rbc_data, s3, BUCKET, STAGING_KEY)[1]
+
+    def load_dashboard():
+        # the manifest and the first page of the transactions explorer
+        manifest = read_manifest(s3, BUCKET, OUTPUT_PREFIX)
+        months = list_months(manifest)
+        where, params = explorer_filter(pd.Period(months[0]).start_time.date(), pd.Period(months[-1]).end_time.date(),
+                                        [], [], '')
+        with duckdb.connect() as con:
+            register_transactions(con, s3, BUCKET, manifest, months)
+            con.execute(f'SELECT COUNT(*) FROM transactions {where}', list(params)).fetchall()
+            con.execute(explorer_page_sql(where, 'Date', True, PAGE_SIZES[0], 1), list(params)).df()
+        return manifest
+
+    parsed = categorize(rng, stage('import', import_export))
+    stage('save', lambda: append_output_data(parsed, s3, BUCKET, OUTPUT_PREFIX))
+    stage('compact', lambda: compact_output(s3, BUCKET, OUTPUT_PREFIX, force=True))
+    stage('save_increment', lambda: append_output_data(increment, s3, BUCKET, OUTPUT_PREFIX))
+    stage('dashboard_load_cold', load_dashboard)
+    manifest = stage('dashboard_load_warm', load_dashboard)
+    stage('aggregate', lambda: aggregate(s3, manifest))
+    return results
+
+
+def compare(results, baseline):
+    print(f"\n{'rows':>10}  {'stage':<20}{'seconds':>10}{'baseline':>10}{'ratio':>8}")
+    for size, stages in results['sizes'].items():
+        for name, current in stages.items():
+            previous = baseline.get('sizes', {}).get(size, {}).get(name)
+            if previous:
+                print(f"{size:>10}  {name:<20}{current['seconds']:>10.3f}{previous['seconds']:>10.3f}"
+                      f"{current['seconds'] / previous['seconds']:>7.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sizes', nargs='*', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('--output', help='JSON file of the results, in benchmarks/results/ by default')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = {'created': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'sizes': {}}
+    print(f"{'rows':>10}  {'stage':<20}{'seconds':>10}{'requests':>10}{'MB read':>10}{'MB written':>12}{'peak RSS MB':>13}")
+    for nb_rows in args.sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            # a fresh process, S3 stand-in and local cache for every size
+            os.environ['S3_CACHE_DIR'] = os.path.join(work_dir, 's3_cache')
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                stages = executor.submit(run_size, nb_rows, os.path.join(work_dir, 's3')).result()
+        results['sizes'][str(nb_rows)] = stages
+        for name, stats in stages.items():
+            print(f"{nb_rows:>10}  {name:<20}{stats['seconds']:>10.3f}{stats['requests']:>10}"
+                  f"{stats['bytes_read'] / 1e6:>10.2f}{stats['bytes_written'] / 1e6:>12.2f}{stats['peak_rss'] / 1e6:>13.1f}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"pipeline-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"\nResults written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,95 @@
+# Benchmark of the .xlsx import against the CSV import of the same bank statements
+#
+# Usage: python benchmarks/bench_xlsx.py [nb_rows ...]
+# Every synthetic statement of bench_parsers.py is written as a CSV export and as an .xlsx
+# export split over several sheets (with date cells), then read in chunks and parsed like an
+# import. The throughput and the Python peak memory (traced in a second run, tracing slows
+# the import down) of both paths are reported, and the parsed transactions of the .xlsx
+# export are checked against the ones of the CSV export.
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_parsers import PARSERS
+from utils import CHUNK_SIZE, accountFormats, read_export_chunks
+
+DEFAULT_SIZES = [10_000, 100_000]
+# rows of a sheet of the .xlsx exports
+SHEET_ROWS = 40_000
+# columns written as date cells in the .xlsx exports, with their format in the CSV exports
+dateCol = {"Date de l'opération": '%m/%d/%Y', 'Date': '%Y-%m-%d'}
+
+
+def to_csv_bytes(df, sep):
+    return df.to_csv(index=False, sep=sep).encode('utf-8')
+
+
+def to_xlsx_bytes(df):
+    # a streamed (write-only) workbook, as large exports are written
+    df = df.copy()
+    for col, date_format in dateCol.items():
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], format=date_format)
+    workbook = openpyxl.Workbook(write_only=True)
+    for start in range(0, max(len(df), 1), SHEET_ROWS):
+        worksheet = workbook.create_sheet(f'Transactions {start // SHEET_ROWS + 1}')
+        worksheet.append(list(df.columns))
+        for row in df.iloc[start:start + SHEET_ROWS].itertuples(index=False):
+            worksheet.append([None if isinstance(value, float) and np.isnan(value) else
+                              value.to_pydatetime() if isinstance(value, pd.Timestamp) else value
+                              for value in row])
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def import_export(data, account, parser):
+    # read and parse the export one chunk at a time, like ingest_chunks
+    start = time.perf_counter()
+    frames = []
+    for chunk in read_export_chunks(data, account):
+        ret, parsed = parser(chunk.copy())
+        if ret != 100:
+            sys.exit(f"{account} parser returned {ret}")
+        frames.append(parsed)
+    return time.perf_counter() - start, pd.concat(frames, ignore_index=True)
+
+
+def import_peak_memory(data, account, parser):
+    # peak of the memory held while reading and parsing, the parsed chunks are dropped
+    tracemalloc.start()
+    for chunk in read_export_chunks(data, account):
+        parser(chunk.copy())
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak_memory
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    rng = np.random.default_rng(42)
+
+    print(f"chunks of {CHUNK_SIZE} rows, .xlsx sheets of {SHEET_ROWS} rows")
+    print(f"{'parser':<12}{'rows':>10}{'csv (MB)':>10}{'xlsx (MB)':>11}{'csv rows/s':>12}{'xlsx rows/s':>13}"
+          f"{'csv peak (MB)':>15}{'xlsx peak (MB)':>16}")
+    for name, make_statement, parser, _ in PARSERS:
+        for nb_rows in sizes:
+            df = make_statement(rng, nb_rows)
+            csv_data = to_csv_bytes(df, accountFormats[name][1])
+            xlsx_data = to_xlsx_bytes(df)
+            csv_time, csv_parsed = import_export(csv_data, name, parser)
+            xlsx_time, xlsx_parsed = import_export(xlsx_data, name, parser)
+            csv_peak = import_peak_memory(csv_data, name, parser)
+            xlsx_peak = import_peak_memory(xlsx_data, name, parser)
+            pd.testing.assert_frame_equal(xlsx_parsed, csv_parsed, check_dtype=False)
+            print(f"{name:<12}{nb_rows:>10}{len(csv_data) / 1e6:>10.1f}{len(xlsx_data) / 1e6:>11.1f}"
+                  f"{nb_rows / csv_time:>12,.0f}{nb_rows / xlsx_time:>13,.0f}"
+                  f"{csv_peak / 1e6:>15.1f}{xlsx_peak / 1e6:>16.1f}")
@@ -0,0 +1,63 @@
+# Stand-in for the S3 client, for offline benchmarks
+#
+# The local filesystem storage backend, seen as a remote S3 bucket (reads go through the
+# local S3 cache like with the boto3 client), counting the requests and the bytes read and
+# written by the client.
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import LocalStorageClient
+
+
+class LocalS3Client(LocalStorageClient):
+    """
+    S3 client storing the objects of every bucket in a local directory.
+
+    Parameters:
+    root (str): The directory holding the buckets.
+    """
+    is_remote = True
+
+    def __init__(self, root):
+        super().__init__(root)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'bytes_read': 0, 'bytes_written': 0}
+
+    def _count(self, bytes_read=0, bytes_written=0):
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_read'] += bytes_read
+            self.stats['bytes_written'] += bytes_written
+
+    def get_object(self, Bucket, Key, **kwargs):
+        try:
+            obj = super().get_object(Bucket, Key, **kwargs)
+        except Exception:
+            self._count()
+            raise
+        self._count(bytes_read=obj['ContentLength'])
+        return obj
+
+    def head_object(self, Bucket, Key):
+        self._count()
+        return super().head_object(Bucket, Key)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        # str bodies (CSV) are sent encoded
+        Body = Body.encode('utf-8') if isinstance(Body, str) else Body
+        self._count(bytes_written=len(Body))
+        return super().put_object(Bucket, Key, Body, **kwargs)
+
+    def delete_object(self, Bucket, Key):
+        self._count()
+        return super().delete_object(Bucket, Key)
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._count()
+        return super().list_objects_v2(Bucket, Prefix, **kwargs)
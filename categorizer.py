@@ -0,0 +1,108 @@
+# Auto-categorization of imported transactions from the categorized history
+import pandas as pd
+
+# index levels, from the most to the least specific, with the confidence weight of a match
+indexLevels = {
+    'description': 1.0,  # whole normalized description
+    'merchant': 0.9,     # description before the ' / ' separator
+    'prefix': 0.75,      # first two words of the merchant
+}
+indexCol = ['level', 'key', 'Category', 'Sub Category', 'count']
+
+
+def index_keys(descriptions):
+    """
+    Compute the lookup key of every index level for some descriptions.
+
+    Parameters:
+    descriptions (pandas.Series): The transaction descriptions.
+
+    Returns:
+    pandas.DataFrame: One column per index level, with an empty key when nothing is left
+        after normalization.
+    """
+    def normalize(text):
+        return text.str.upper().str.replace(r'[\W\d_]+', ' ', regex=True).str.strip()
+
+    descriptions = descriptions.fillna('').astype(str)
+    merchants = normalize(descriptions.str.split(' / ', n=1).str[0])
+    return pd.DataFrame({
+        'description': normalize(descriptions),
+        'merchant': merchants,
+        'prefix': merchants.str.split(' ', n=2).str[:2].str.join(' '),
+    }, index=descriptions.index)
+
+
+def build_index(df):
+    """
+    Count the categories used for every key of every index level.
+
+    Parameters:
+    df (pandas.DataFrame): Categorized transactions.
+
+    Returns:
+    pandas.DataFrame: The index, in the indexCol layout.
+    """
+    df = df[df['Category'].notna() & (df['Category'] != '')]
+    keys = index_keys(df['Description'])
+    frames = []
+    for level in indexLevels:
+        counts = df.assign(key=keys[level]).groupby(['key', 'Category', 'Sub Category'], observed=True).size()
+        counts = counts.rename('count').reset_index()
+        counts.insert(0, 'level', level)
+        frames.append(counts[counts['key'] != ''])
+    index = pd.concat(frames, ignore_index=True)[indexCol]
+    return index.astype({'Category': object, 'Sub Category': object})
+
+
+def merge_index(index, new_index):
+    """
+    Add the counts of new_index to index.
+    """
+    merged = pd.concat([index, new_index], ignore_index=True)
+    return merged.groupby(['level', 'key', 'Category', 'Sub Category'])['count'].sum().reset_index()[indexCol]
+
+
+def suggest_categories(df, index, category_dict):
+    """
+    Pre-fill the category of uncategorized transactions from the index.
+
+    Every index level is looked up with a single hash join over the whole statement,
+    the most specific level wins. Only category and sub category pairs valid under
+    set_category are suggested.
+
+    Parameters:
+    df (pandas.DataFrame): The parsed transactions, in the cleanedCol layout.
+    index (pandas.DataFrame): The categorization index, None when there is no history.
+    category_dict (dict): The sub categories of every category, from set_category.
+
+    Returns:
+    pandas.DataFrame: A copy of df with the suggested categories and a Confidence column
+        (0 to 1, 0 when there is no suggestion).
+    """
+    df = df.copy()
+    df['Confidence'] = 0.0
+    if index is None or index.empty:
+        return df
+
+    valid_pairs = {(category, sub_category)
+                   for category, sub_categories in category_dict.items() for sub_category in sub_categories}
+    is_valid = pd.Series(list(zip(index['Category'], index['Sub Category'])), index=index.index).isin(valid_pairs)
+    index = index[is_valid]
+
+    # most frequent category of every key, with its share of the key's transactions
+    totals = index.groupby(['level', 'key'])['count'].transform('sum')
+    best = (index.assign(share=index['count'] / totals)
+            .sort_values('count', ascending=False, kind='stable')
+            .drop_duplicates(['level', 'key']))
+
+    keys = index_keys(df['Description'])
+    todo = df['Category'].fillna('') == ''
+    for level, weight in indexLevels.items():
+        candidates = keys.loc[todo, [level]].rename(columns={level: 'key'}).reset_index()
+        matched = candidates.merge(best[best['level'] == level], on='key').set_index(candidates.columns[0])
+        df.loc[matched.index, 'Category'] = matched['Category']
+        df.loc[matched.index, 'Sub Category'] = matched['Sub Category']
+        df.loc[matched.index, 'Confidence'] = matched['share'] * weight
+        todo.loc[matched.index] = False
+    return df
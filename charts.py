@@ -0,0 +1,118 @@
+# Charts of the home page, cached per data version and shared by all sessions
+#
+# A figure is built once for a (chart kind, year, month, category) of a version of the output
+# store, and kept in the cache of the tenant owning the store (see tenancy.py): reruns, other
+# sessions of the tenant and month switches reuse it instead of querying and building it
+# again. After a save, the figures of the most recent months are built in the background, and
+# the first figure or query result of the new version drops the ones of the previous versions.
+import threading
+
+import plotly.express as px
+
+from output_store import UNKNOWN_MONTH, list_months, read_manifest
+from query import categoryDistributionSql, monthlySummarySql, query_transactions, subCategoryDistributionSql
+from tenancy import data_cache, tenant_of
+from tracing import count, span
+
+# months whose figures are built after a save
+PRECOMPUTE_MONTHS = 3
+
+
+def year_months(manifest, year):
+    """
+    The months (yyyy-mm) of a year holding transactions in the store.
+    """
+    return [month for month in list_months(manifest) if month[:4] == str(year)]
+
+
+def build_figure(kind, s3_client, bucket, prefix, manifest, month=None, category=None, year=None):
+    """
+    Query the data of a chart and build its figure.
+
+    Parameters:
+    kind (str): 'summary', 'category' or 'sub_category'.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    manifest (dict): The manifest of the store.
+    month (str): The month (yyyy-mm) of the category and sub category charts.
+    category (str): The category of the sub category chart.
+    year (int): The year of the summary chart. All years when None.
+
+    Returns:
+    plotly.graph_objects.Figure: The figure.
+    """
+    def query(sql, params=(), months=None):
+        return query_transactions(s3_client, bucket, prefix, manifest, manifest['version'], sql, params, months)
+
+    if kind == 'summary':
+        months = tuple(year_months(manifest, year)) if year is not None else None
+        return px.bar(query(monthlySummarySql, months=months), x='Month', y='Amount', color='Type', barmode='group',
+                      title='Revenus vs Depenses par mois')
+    if kind == 'category':
+        return px.bar(query(categoryDistributionSql, (month,), (month,)), x='Amount', y='Category',
+                      orientation='h', title='Expense Distribution by Category')
+    if kind == 'sub_category':
+        return px.bar(query(subCategoryDistributionSql, (month, category), (month,)), x='Sub Category',
+                      y='Amount', title=f'Expense Distribution in {category}')
+    raise ValueError(f"Unknown chart {kind}, expected summary, category or sub_category")
+
+
+def get_figure(kind, s3_client, bucket, prefix, manifest, month=None, category=None, year=None):
+    """
+    Get the figure of a chart for the version of the store, from the cache when it was
+    already built. Cached figures are shared, they must not be modified.
+
+    Parameters:
+    See build_figure.
+
+    Returns:
+    plotly.graph_objects.Figure: The figure.
+    """
+    # only the summary is of a year, the figures of a month are the same whatever the selected year
+    if kind != 'summary':
+        year = None
+    tenant = tenant_of(prefix)
+    key = ('figure', bucket, prefix, manifest['version'], kind, year, month, category)
+    hit, figure = data_cache.get(tenant, key)
+    if hit:
+        count('figure_cache_hits')
+        return figure
+
+    count('figure_cache_misses')
+    with span('build_figure', kind=kind):
+        figure = build_figure(kind, s3_client, bucket, prefix, manifest, month, category, year)
+    data_cache.put(tenant, key, figure, scope=prefix, version=manifest['version'])
+    return figure
+
+
+def precompute_figures(s3_client, bucket, prefix, nb_months=PRECOMPUTE_MONTHS):
+    """
+    Build the figures of the current version of the store for its most recent months:
+    the summary of their years, and the category and every sub category chart of each month.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    nb_months (int): The number of months.
+    """
+    try:
+        manifest = read_manifest(s3_client, bucket, prefix)
+        months = [month for month in list_months(manifest) if month != UNKNOWN_MONTH][-nb_months:]
+        for year in sorted({month[:4] for month in months}):
+            get_figure('summary', s3_client, bucket, prefix, manifest, year=int(year))
+        for month in reversed(months):
+            get_figure('category', s3_client, bucket, prefix, manifest, month)
+            categories = query_transactions(s3_client, bucket, prefix, manifest, manifest['version'],
+                                            categoryDistributionSql, (month,), (month,))['Category']
+            for category in categories.unique():
+                get_figure('sub_category', s3_client, bucket, prefix, manifest, month, category)
+        print(f"Figures of {bucket}/{prefix} version {manifest['version']} precomputed")
+    except Exception as e:
+        print(f"Error precomputing the figures of {bucket}/{prefix}: {e}")
+
+
+def start_precompute_figures(s3_client, bucket, prefix):
+    # in the background, the save returns without waiting for the figures
+    threading.Thread(target=precompute_figures, args=(s3_client, bucket, prefix), daemon=True).start()
@@ -0,0 +1,96 @@
+# Detection of transactions already saved, across overlapping statements
+#
+# A transaction is identified by the hash of its Name, Account, Date, Type and Amount. The
+# duplicate index of the history holds that key and the normalized description of every
+# saved transaction, so a new batch is checked with hash lookups on its own keys. When a key
+# matches, the most similar description of the history is the candidate: a suspected
+# duplicate when the two descriptions are similar enough, a distinct transaction otherwise
+# (two payments of the same amount to different merchants on the same day).
+from difflib import SequenceMatcher
+
+import pandas as pd
+
+from categorizer import index_keys
+from schema import DATE_FORMAT, parse_dates, to_cents
+
+duplicateCol = ['key', 'description']
+# similarity (0 to 1) of the normalized descriptions above which a key match is a duplicate
+DUPLICATE_MIN_SIMILARITY = 0.6
+
+
+def duplicate_keys(df, cents=False):
+    """
+    Hash the identity (Name, Account, Date, Type, Amount) of some transactions.
+
+    Amounts are unsigned in the store, the Type tells an expense from a refund of the same amount.
+
+    Parameters:
+    df (pandas.DataFrame): Transactions, typed or with string dates.
+    cents (bool): The amounts are in cents (typed transactions of the store), in dollars otherwise.
+
+    Returns:
+    pandas.Series: One uint64 key per transaction, indexed like df.
+    """
+    dates = parse_dates(df['Date']).dt.strftime(DATE_FORMAT).fillna('')
+    amounts = df['Amount'].astype('Int64') if cents else to_cents(df['Amount'])
+    joined = (df['Name'].astype(str) + '\x1f' + df['Account'].astype(str) + '\x1f' + dates + '\x1f'
+              + df['Type'].astype(str) + '\x1f' + amounts.astype(str))
+    return pd.util.hash_pandas_object(joined, index=False)
+
+
+def build_duplicate_index(df):
+    """
+    Build the duplicate index of some transactions of the store.
+
+    Parameters:
+    df (pandas.DataFrame): Typed transactions (see schema.py).
+
+    Returns:
+    pandas.DataFrame: The index, in the duplicateCol layout.
+    """
+    return pd.DataFrame({'key': duplicate_keys(df, cents=True).to_numpy(),
+                         'description': index_keys(df['Description'])['description'].to_numpy()},
+                        columns=duplicateCol)
+
+
+def description_similarity(first, second):
+    return SequenceMatcher(None, first, second).ratio()
+
+
+def match_duplicates(df, index):
+    """
+    Find the transactions of a batch already in the history.
+
+    The batch is hash joined with the index on its keys, and only the matched rows are
+    compared. A history transaction is the duplicate of a single batch transaction, so a
+    statement with two identical payments on the same day matches both only when the
+    history holds both.
+
+    Parameters:
+    df (pandas.DataFrame): The new transactions, amounts in dollars.
+    index (pandas.DataFrame): The duplicate index of the history, None when there is no history.
+
+    Returns:
+    pandas.Series: The description similarity with the duplicate of every transaction
+        (0 when it is not a suspected duplicate), indexed like df.
+    """
+    scores = pd.Series(0.0, index=df.index)
+    if index is None or index.empty or df.empty:
+        return scores
+
+    keys = duplicate_keys(df)
+    matched = keys[keys.isin(index['key'])]
+    if matched.empty:
+        return scores
+    candidates = index[index['key'].isin(matched)].groupby('key')['description'].agg(list).to_dict()
+    descriptions = index_keys(df.loc[matched.index, 'Description'])['description']
+    for row, key in matched.items():
+        remaining = candidates[key]
+        if not remaining:
+            continue
+        similarities = [description_similarity(descriptions[row], candidate) for candidate in remaining]
+        best = max(range(len(remaining)), key=similarities.__getitem__)
+        if similarities[best] >= DUPLICATE_MIN_SIMILARITY:
+            scores[row] = similarities[best]
+            remaining.pop(best)
+    return scores
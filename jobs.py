@@ -0,0 +1,202 @@
+# Background jobs (imports and saves) run off the Streamlit script thread
+#
+# A job runs in the job pool and reports its progress in a status shared by all sessions
+# and persisted under JOBS_DIR. Pages keep the job id in the URL (st.query_params) and poll
+# the status, so the user can keep working and a browser refresh finds the job again.
+# Results stay in memory until the page that submitted the job consumes them. A job belongs
+# to a tenant (see tenancy.py) and to the browser that submitted it, identified by a token
+# kept in the URL and the session (job_owner): the pages only follow the jobs of their own
+# browser, another session of the tenant can't take their results.
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+JOBS_DIR = os.environ.get('JOBS_DIR', '.jobs')
+JOB_WORKERS = 2
+# seconds between two refreshes of the progress of a running job
+JOB_POLL_SECONDS = 1.0
+# finished jobs not consumed after this many seconds are forgotten
+JOB_RETENTION_SECONDS = 24 * 3600
+JOB_QUERY_PARAM = 'job'
+JOB_OWNER_PARAM = 'owner'
+activeStatuses = ('queued', 'running')
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+_lock = threading.Lock()
+# job id -> status, and job id -> result of the finished jobs
+_jobs = {}
+_results = {}
+
+
+def _status_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def _save_status(job):
+    try:
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        tmp_path = _status_path(job['id']) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, _status_path(job['id']))
+    except OSError as e:
+        print(f"Error saving the status of job {job['id']}: {e}")
+
+
+def _update_job(job_id, **changes):
+    with _lock:
+        job = _jobs[job_id]
+        job.update(changes)
+        job = dict(job)
+    _save_status(job)
+
+
+def _forget_old_jobs():
+    now = time.time()
+    with _lock:
+        old = [job_id for job_id, job in _jobs.items()
+               if job['finished_at'] is not None and now - job['finished_at'] > JOB_RETENTION_SECONDS]
+        for job_id in old:
+            _jobs.pop(job_id)
+            _results.pop(job_id, None)
+    for job_id in old:
+        try:
+            os.remove(_status_path(job_id))
+        except OSError:
+            pass
+
+
+def _run_job(job_id, fn, args, kwargs):
+    _update_job(job_id, status='running', message='Running', started_at=time.time())
+
+    def progress(fraction, message):
+        _update_job(job_id, progress=min(max(float(fraction), 0.0), 1.0), message=message)
+
+    try:
+        result = fn(progress, *args, **kwargs)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e!r}")
+        _update_job(job_id, status='failed', message='Failed', error=str(e), finished_at=time.time())
+        return
+    with _lock:
+        _results[job_id] = result
+    _update_job(job_id, status='done', progress=1.0, message='Done', finished_at=time.time())
+
+
+def job_owner():
+    """
+    The token of the browser of the session, the owner of the jobs it submits.
+
+    It is created with the session and kept in the URL, so a refresh of the page (a new
+    session) keeps it, and in the session state, so the navigation between pages keeps it.
+    """
+    owner = st.session_state.get('job_owner') or st.query_params.get(JOB_OWNER_PARAM) or uuid.uuid4().hex
+    st.session_state['job_owner'] = owner
+    if st.query_params.get(JOB_OWNER_PARAM) != owner:
+        st.query_params[JOB_OWNER_PARAM] = owner
+    return owner
+
+
+def submit_job(tenant, owner, kind, fn, *args, **kwargs):
+    """
+    Run a function in the job pool.
+
+    Parameters:
+    tenant (str): The tenant the job works for.
+    owner (str): The token of the browser submitting the job (see job_owner).
+    kind (str): The kind of job ('ingest', 'save'...), for the pages looking for their jobs.
+    fn (function): The job, called as fn(progress, *args, **kwargs) where progress(fraction, message)
+        reports its progress (fraction from 0 to 1). Its return value is the result of the job.
+
+    Returns:
+    str: The id of the job.
+    """
+    _forget_old_jobs()
+    job = {'id': uuid.uuid4().hex, 'tenant': tenant, 'owner': owner, 'kind': kind, 'status': 'queued', 'progress': 0.0, 'message': 'Queued',
+           'error': None, 'consumed': False, 'submitted_at': time.time(), 'started_at': None,
+           'finished_at': None}
+    with _lock:
+        _jobs[job['id']] = job
+    _save_status(job)
+    _executor.submit(_run_job, job['id'], fn, args, kwargs)
+    return job['id']
+
+
+def get_job(job_id):
+    """
+    Get the status of a job: tenant, owner, kind, status (queued, running, done, failed or interrupted),
+    progress, message and error.
+
+    Returns:
+    dict: A copy of the status, None for an unknown job.
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    # a job of a previous run of the server, its result was lost with the process
+    try:
+        with open(_status_path(os.path.basename(job_id))) as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if job['status'] in activeStatuses or (job['status'] == 'done' and not job['consumed']):
+        job.update(status='interrupted', error='The server restarted before the result was read')
+    return job
+
+
+def pending_job(tenant, owner, kinds):
+    """
+    Get the id of the latest job of a tenant and browser of some kinds not consumed yet, to
+    find the jobs of a page opened without the job id in its URL.
+    """
+    with _lock:
+        jobs = [job for job in _jobs.values()
+                if job['tenant'] == tenant and job['owner'] == owner and job['kind'] in kinds and not job['consumed']]
+    return max(jobs, key=lambda job: job['submitted_at'])['id'] if jobs else None
+
+
+def consume_job(job_id):
+    """
+    Take the result of a finished job, it is returned only once.
+
+    Returns:
+    tuple: The status of the job, 'done', 'failed' or 'interrupted', or 'consumed' when it was
+        already consumed, and the return value of the job function ('done' only, None otherwise).
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        result = _results.pop(job_id, None)
+        if job is not None:
+            consumed = job['consumed']
+            job['consumed'] = True
+            job = dict(job)
+    if job is None:
+        # a job of a previous run of the server, only its status is left
+        job = get_job(job_id)
+        if job is None:
+            return 'interrupted', None
+        consumed = job['consumed']
+    else:
+        _save_status(job)
+    if consumed:
+        return 'consumed', None
+    return job['status'], result
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def display_job_progress(job_id):
+    """
+    Show the progress of a running job, refreshed every JOB_POLL_SECONDS without rerunning
+    the page. The page is rerun once the job finished, to consume its result.
+    """
+    job = get_job(job_id)
+    if job is not None and job['status'] in activeStatuses:
+        st.progress(job['progress'], text=f"{job['kind'].capitalize()}: {job['message']}")
+    else:
+        st.rerun()
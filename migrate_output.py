@@ -0,0 +1,32 @@
+# One-shot migration of <env>/output/combined_transactions.csv to the month-partitioned Parquet store
+#
+# Usage: python migrate_output.py [prod|local] [tenant]
+# The tenant (household) is the default one, with the keys of the single household layout,
+# when not given. AWS credentials are read from the environment or the .env file.
+import sys
+
+import boto3
+from dotenv import load_dotenv
+
+from output_store import migrate_csv_output
+from tenancy import DEFAULT_TENANT, tenant_keys, tenant_root
+from utils import BUCKET_NAME
+
+FILE_KEY_LEGACY_OUTPUT = '/output/combined_transactions.csv'
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    env_folder = sys.argv[1] if len(sys.argv) > 1 else 'local'
+    if env_folder not in ('prod', 'local'):
+        sys.exit(f"Unknown environment {env_folder}, expected prod or local")
+    tenant = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_TENANT
+    try:
+        output_prefix = tenant_keys(env_folder, tenant)['output']
+    except ValueError as e:
+        sys.exit(str(e))
+
+    s3 = boto3.client('s3')
+    nb_rows = migrate_csv_output(s3, BUCKET_NAME, tenant_root(tenant) + env_folder + FILE_KEY_LEGACY_OUTPUT,
+                                 output_prefix)
+    print(f"Migrated {nb_rows} transactions to {BUCKET_NAME}/{output_prefix}")
@@ -0,0 +1,585 @@
+# Month-partitioned Parquet store for the consolidated transactions
+#
+# The store is a base (one Parquet part per month, the monthly rollups, the
+# auto-categorization index and the monthly duplicate indexes) plus a log of segments: every save writes its transactions as
+# one immutable segment and appends it to the manifest. Readers merge the base with the
+# segments, and compact_output folds the segments into the base in the background.
+import json
+import threading
+import time
+import uuid
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+from categorizer import build_index, merge_index
+from duplicates import build_duplicate_index, duplicateCol, match_duplicates
+from s3_cache import get_object_bytes, is_remote
+from schema import concat_transactions, outputCol, parse_dates, to_dollars, transaction_problems, typed_table, \
+    typed_transactions, validate_transactions
+from storage import delete_objects, fetch_objects, put_objects
+
+MANIFEST_NAME = '_manifest.json'
+UNKNOWN_MONTH = 'unknown'
+
+# segments accumulated before a save starts a compaction
+COMPACT_MAX_SEGMENTS = 8
+COMPACT_MAX_SEGMENT_ROWS = 20_000
+# attempts to append a segment to the manifest when concurrent saves win the race
+MANIFEST_UPDATE_ATTEMPTS = 10
+# seconds the objects replaced by a compaction are kept for the readers of the previous manifests
+COMPACT_RETIRE_SECONDS = 600
+
+# group keys of the monthly rollups maintained at save time
+rollupKeys = {
+    'month_type': ['Month', 'Type'],
+    'month_category': ['Month', 'Type', 'Category'],
+    'month_sub_category': ['Month', 'Type', 'Category', 'Sub Category'],
+}
+
+# a single compaction at a time in the process
+_compaction_lock = threading.Lock()
+
+
+def month_of(dates):
+    """
+    Compute the partition month (yyyy-mm) of each date.
+
+    Parameters:
+    dates (pandas.Series): The transaction dates.
+
+    Returns:
+    pandas.Series: The month of each date, UNKNOWN_MONTH when the date can't be parsed.
+    """
+    return parse_dates(dates).dt.strftime('%Y-%m').fillna(UNKNOWN_MONTH)
+
+
+def partition_prefix(prefix, month):
+    return f"{prefix}month={month}/"
+
+
+def empty_manifest():
+    return {'version': 0, 'partitions': {}, 'segments': []}
+
+
+def is_empty(manifest):
+    return not manifest['partitions'] and not manifest['segments']
+
+
+def parse_manifest(data):
+    # manifests written before the segment log have no 'segments'
+    return {'segments': [], **json.loads(data.decode('utf-8'))}
+
+
+def read_manifest(s3_client, bucket, prefix):
+    """
+    Read the manifest of the output store.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+
+    Returns:
+    dict: The manifest. An empty store has version 0, no partitions and no segments.
+    """
+    try:
+        data = get_object_bytes(s3_client, bucket, prefix + MANIFEST_NAME)
+    except ClientError:
+        return empty_manifest()
+    return parse_manifest(data)
+
+
+def read_manifest_for_update(s3_client, bucket, prefix):
+    """
+    Read the manifest of the output store straight from S3, with its ETag.
+
+    Returns:
+    tuple: The manifest and its ETag, None when the store has no manifest yet.
+    """
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=prefix + MANIFEST_NAME)
+    except ClientError:
+        return empty_manifest(), None
+    return parse_manifest(obj['Body'].read()), obj['ETag']
+
+
+def write_manifest(s3_client, bucket, prefix, manifest, etag):
+    """
+    Write the manifest, only if it didn't change since it was read (conditional put).
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    manifest (dict): The new manifest.
+    etag (str): The ETag of the manifest read, None when there was none.
+
+    Returns:
+    bool: False when the manifest was changed by another writer in the meantime.
+    """
+    condition = {'IfNoneMatch': '*'} if etag is None else {'IfMatch': etag}
+    try:
+        s3_client.put_object(Bucket=bucket, Key=prefix + MANIFEST_NAME,
+                             Body=json.dumps(manifest, indent=1).encode('utf-8'), **condition)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+    return True
+
+
+def read_parquet_from_s3(s3_client, bucket, file_key):
+    if not is_remote(s3_client) and hasattr(s3_client, 'read_parquet'):
+        # local backend, memory mapped
+        return s3_client.read_parquet(bucket, file_key).to_pandas()
+    # parts are written once under a unique name, a cached copy is always current
+    data = get_object_bytes(s3_client, bucket, file_key, immutable=True)
+    return pd.read_parquet(BytesIO(data))
+
+
+def read_parquet_tables(s3_client, bucket, file_keys):
+    """
+    Read several Parquet objects of the store concurrently, as Arrow tables.
+
+    Returns:
+    dict: The table of every object, by key.
+    """
+    if not is_remote(s3_client) and hasattr(s3_client, 'read_parquet'):
+        # local backend, memory mapped
+        return {key: s3_client.read_parquet(bucket, key) for key in dict.fromkeys(file_keys)}
+    contents = fetch_objects(s3_client, bucket, file_keys, immutable=True)
+    return {key: pq.read_table(BytesIO(data)) for key, data in contents.items()}
+
+
+def read_parquet_objects(s3_client, bucket, file_keys):
+    """
+    Read several Parquet objects of the store concurrently.
+
+    Returns:
+    dict: The DataFrame of every object, by key.
+    """
+    return {key: table.to_pandas() for key, table in read_parquet_tables(s3_client, bucket, file_keys).items()}
+
+
+def to_parquet_bytes(df):
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def write_parquet_to_s3(df, s3_client, bucket, file_key):
+    s3_client.put_object(Bucket=bucket, Key=file_key, Body=to_parquet_bytes(df))
+
+
+def compute_rollups(df, months):
+    """
+    Compute the monthly rollups of some transactions.
+
+    Parameters:
+    df (pandas.DataFrame): The transactions.
+    months (pandas.Series): The month of each transaction.
+
+    Returns:
+    dict: The month x type, month x category and month x category x sub category sums,
+        in dollars.
+    """
+    df = df.assign(Month=months)
+    df = df[df['Month'] != UNKNOWN_MONTH]
+    rollups = {}
+    for name, keys in rollupKeys.items():
+        df_rollup = df.groupby(keys, observed=True)['Amount'].sum().reset_index()
+        rollups[name] = df_rollup.astype({key: object for key in keys}).assign(Amount=to_dollars(df_rollup['Amount']))
+    return rollups
+
+
+def replace_rollup_months(rollups, month_frames):
+    """
+    Replace the rollup rows of some months by the rollups of their full content.
+
+    Parameters:
+    rollups (dict): The rollups, None when there are none yet.
+    month_frames (dict): The full content of every month to replace.
+
+    Returns:
+    dict: The new rollups, None when there is nothing at all.
+    """
+    if not month_frames:
+        return rollups
+    df_months = concat_transactions(list(month_frames.values()))
+    touched = compute_rollups(df_months, month_of(df_months['Date']))
+    if rollups is None:
+        return touched
+    return {name: pd.concat([rollups[name][~rollups[name]['Month'].isin(month_frames.keys())], df_touched],
+                            ignore_index=True).sort_values(rollupKeys[name], ignore_index=True)
+            for name, df_touched in touched.items()}
+
+
+def segment_months(manifest):
+    return sorted({month for segment in manifest['segments'] for month in segment['months']})
+
+
+def list_months(manifest):
+    return sorted(set(manifest['partitions']).union(segment_months(manifest)))
+
+
+def read_transactions(s3_client, bucket, manifest, months):
+    """
+    Read the transactions of some months, merging their base part with the segments.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    manifest (dict): The manifest.
+    months (list): The months (yyyy-mm) to read.
+
+    Returns:
+    pandas.DataFrame: The deduplicated and typed transactions (see schema.py).
+    """
+    months = set(months)
+    partitions = manifest['partitions']
+    part_keys = [partitions[month]['key'] for month in sorted(months) if month in partitions]
+    segment_keys = [segment['key'] for segment in manifest['segments'] if months.intersection(segment['months'])]
+    tables = read_parquet_tables(s3_client, bucket, part_keys + segment_keys)
+
+    # a single conversion to pandas, parts and segments written before the schema are typed first
+    frames = [table.to_pandas() for table in
+              (pa.concat_tables([typed_table(tables[key]) for key in keys], promote_options='permissive')
+               for keys in (part_keys, segment_keys) if keys)]
+    if not frames:
+        return typed_transactions(pd.DataFrame(columns=outputCol))
+    df = typed_transactions(frames[0], cents=True)
+    if segment_keys:
+        # segments hold rows of other months, and rows already in the parts
+        df_segments = typed_transactions(frames[-1], cents=True)
+        df_segments = df_segments[month_of(df_segments['Date']).isin(months)]
+        df = concat_transactions([df, df_segments] if part_keys else [df_segments])
+        # remove duplicates
+        df = df.drop_duplicates().reset_index(drop=True)
+    return df
+
+
+def read_months(s3_client, bucket, manifest, months):
+    """
+    Read the full content of some months, merging their base part with the segments.
+
+    Returns:
+    dict: The deduplicated and typed transactions of every month holding some, by month.
+    """
+    df = read_transactions(s3_client, bucket, manifest, months)
+    return {month: df_month.reset_index(drop=True) for month, df_month in df.groupby(month_of(df['Date']))}
+
+
+def read_base_rollups(s3_client, bucket, manifest):
+    if not manifest['partitions']:
+        return None
+    if 'rollups' not in manifest:
+        # store written before the rollups existed
+        base = {'partitions': manifest['partitions'], 'segments': []}
+        return replace_rollup_months(None, read_months(s3_client, bucket, base, manifest['partitions']))
+    tables = read_parquet_objects(s3_client, bucket, manifest['rollups'].values())
+    return {name: tables[key] for name, key in manifest['rollups'].items()}
+
+
+def read_rollups(s3_client, bucket, prefix, manifest=None):
+    """
+    Read the monthly rollups of the output store. The rollups of the months with
+    segments not compacted yet are recomputed from the full content of those months.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    manifest (dict): The manifest, read from S3 when None.
+
+    Returns:
+    dict: The rollup tables by name (see rollupKeys), or None if the store is empty.
+    """
+    if manifest is None:
+        manifest = read_manifest(s3_client, bucket, prefix)
+    if is_empty(manifest):
+        return None
+    rollups = read_base_rollups(s3_client, bucket, manifest)
+    rollups = replace_rollup_months(rollups, read_months(s3_client, bucket, manifest, segment_months(manifest)))
+    if rollups is None:
+        # no transaction with a valid date
+        return compute_rollups(pd.DataFrame(columns=outputCol), pd.Series(dtype=object))
+    return rollups
+
+
+def read_categorizer_index(s3_client, bucket, prefix, manifest=None):
+    """
+    Read the auto-categorization index of the output store, segments included.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    manifest (dict): The manifest, read from S3 when None.
+
+    Returns:
+    pandas.DataFrame: The index (see categorizer.build_index), or None if the store is empty.
+    """
+    if manifest is None:
+        manifest = read_manifest(s3_client, bucket, prefix)
+    if is_empty(manifest):
+        return None
+
+    if 'categorizer' in manifest:
+        index = read_parquet_from_s3(s3_client, bucket, manifest['categorizer'])
+    else:
+        # store written before the index existed
+        base = {'partitions': manifest['partitions'], 'segments': []}
+        index = build_index(read_output_data(s3_client, bucket, prefix, manifest=base)
+                            if manifest['partitions'] else pd.DataFrame(columns=outputCol))
+
+    segment_keys = [segment['key'] for segment in manifest['segments']]
+    if segment_keys:
+        frames = read_parquet_objects(s3_client, bucket, segment_keys)
+        index = merge_index(index, build_index(pd.concat([frames[key] for key in segment_keys], ignore_index=True)))
+    return index
+
+
+def read_duplicate_index(s3_client, bucket, prefix, months, manifest=None):
+    """
+    Read the duplicate index of some months of the output store, segments included.
+    Months compacted before the index existed are indexed from their part.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    months (list): The months (yyyy-mm) to read.
+    manifest (dict): The manifest, read from S3 when None.
+
+    Returns:
+    pandas.DataFrame: The index (see duplicates.build_duplicate_index), or None if the store is empty.
+    """
+    if manifest is None:
+        manifest = read_manifest(s3_client, bucket, prefix)
+    if is_empty(manifest):
+        return None
+
+    months = sorted(set(months))
+    duplicates = manifest.get('duplicates', {})
+    stored_keys = [duplicates[month] for month in months if month in duplicates]
+    # parts of the months without an index yet, and segments holding rows of the months
+    other_keys = [manifest['partitions'][month]['key'] for month in months
+                  if month in manifest['partitions'] and month not in duplicates]
+    other_keys += [segment['key'] for segment in manifest['segments'] if set(months).intersection(segment['months'])]
+    tables = read_parquet_tables(s3_client, bucket, stored_keys + other_keys)
+    indexes = [tables[key].to_pandas() for key in stored_keys] + [
+        build_duplicate_index(typed_table(tables[key]).to_pandas()) for key in other_keys]
+    if not indexes:
+        return pd.DataFrame(columns=duplicateCol)
+    return pd.concat(indexes, ignore_index=True)
+
+
+def find_duplicates(df, s3_client, bucket, prefix):
+    """
+    Find the transactions of a batch already saved in the output store. Only the duplicate
+    index of the months of the batch is read.
+
+    Parameters:
+    df (pandas.DataFrame): The new transactions, in the cleanedCol layout.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+
+    Returns:
+    pandas.Series: The description similarity with the saved duplicate of every transaction
+        (0 when it is not a suspected duplicate), indexed like df.
+    """
+    months = month_of(df['Date']).unique()
+    return match_duplicates(df, read_duplicate_index(s3_client, bucket, prefix, months))
+
+
+def read_output_data(s3_client, bucket, prefix, months=None, manifest=None):
+    """
+    Read the consolidated transactions, optionally only for some months.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    months (list): The months (yyyy-mm) to read. All months when None.
+    manifest (dict): The manifest, read from S3 when None.
+
+    Returns:
+    pandas.DataFrame: The typed transactions (see schema.py), or None if the store is empty.
+    """
+    if manifest is None:
+        manifest = read_manifest(s3_client, bucket, prefix)
+    if is_empty(manifest):
+        return None
+    if months is None:
+        months = list_months(manifest)
+
+    return read_transactions(s3_client, bucket, manifest, months)
+
+
+def needs_compaction(manifest):
+    return (len(manifest['segments']) >= COMPACT_MAX_SEGMENTS
+            or sum(segment['rows'] for segment in manifest['segments']) >= COMPACT_MAX_SEGMENT_ROWS)
+
+
+def append_output_data(df_new_data, s3_client, bucket, prefix, unknown_dates=False):
+    """
+    Append transactions to the output store, as a new segment. A save writes the new
+    transactions only, whatever the size of the history, and appends the segment to the
+    manifest with a conditional write, retried when a concurrent save got there first.
+
+    A background compaction is started once enough segments accumulated.
+
+    Raises:
+    ValueError: Some transactions are invalid (see schema.validate_transactions).
+
+    Parameters:
+    df_new_data (pandas.DataFrame): The new transactions, in the cleanedCol layout.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    unknown_dates (bool): Keep the transactions whose date can't be parsed in the UNKNOWN_MONTH
+        partition instead of rejecting them (legacy output migration).
+
+    Returns:
+    list: The months of the saved transactions.
+    """
+    df_new_data = validate_transactions(df_new_data, unknown_dates).reset_index(drop=True)
+    months = sorted(month_of(df_new_data['Date']).unique())
+    segment = {'key': f"{prefix}segments/segment-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet",
+               'rows': len(df_new_data), 'months': months}
+    write_parquet_to_s3(df_new_data, s3_client, bucket, segment['key'])
+
+    for attempt in range(MANIFEST_UPDATE_ATTEMPTS):
+        manifest, etag = read_manifest_for_update(s3_client, bucket, prefix)
+        manifest['segments'].append(segment)
+        manifest['version'] += 1
+        if write_manifest(s3_client, bucket, prefix, manifest, etag):
+            break
+        time.sleep(0.05 * (attempt + 1))
+    else:
+        delete_objects(s3_client, bucket, [segment['key']])
+        raise RuntimeError(f"Can't update {bucket}/{prefix}{MANIFEST_NAME}, too many concurrent saves")
+    print(f"DataFrame uploaded to {bucket}/{segment['key']}")
+
+    if needs_compaction(manifest):
+        threading.Thread(target=compact_output, args=(s3_client, bucket, prefix), daemon=True).start()
+    return months
+
+
+def compact_output(s3_client, bucket, prefix, force=False):
+    """
+    Fold the segments of the output store into its base. The parts of the months with
+    segments, the rollups and the index are rewritten under new keys, then the manifest is
+    replaced with a conditional write. When the manifest changed in the meantime (a save or
+    another compaction), nothing is committed and the next save tries again.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    force (bool): Compact even when the segments are below the thresholds.
+
+    Returns:
+    bool: True when the segments were folded into the base.
+    """
+    if not _compaction_lock.acquire(blocking=False):
+        return False
+    try:
+        manifest, etag = read_manifest_for_update(s3_client, bucket, prefix)
+        if not manifest['segments'] or not (force or needs_compaction(manifest)):
+            return False
+
+        month_frames = read_months(s3_client, bucket, manifest, segment_months(manifest))
+        rollups = replace_rollup_months(read_base_rollups(s3_client, bucket, manifest), month_frames)
+        index = read_categorizer_index(s3_client, bucket, prefix, manifest)
+
+        objects = {}
+        old_keys = [segment['key'] for segment in manifest['segments']]
+        partitions = dict(manifest['partitions'])
+        duplicates = dict(manifest.get('duplicates', {}))
+        for month, df_month in month_frames.items():
+            if month in partitions:
+                old_keys.append(partitions[month]['key'])
+            # write the partition under a new name so readers never see a half written file
+            key = partition_prefix(prefix, month) + f"part-{uuid.uuid4().hex}.parquet"
+            objects[key] = to_parquet_bytes(df_month)
+            partitions[month] = {'key': key, 'rows': len(df_month)}
+
+            if month in duplicates:
+                old_keys.append(duplicates[month])
+            duplicates[month] = f"{prefix}duplicates/{month}-{uuid.uuid4().hex}.parquet"
+            objects[duplicates[month]] = to_parquet_bytes(build_duplicate_index(df_month))
+
+        old_keys += list(manifest.get('rollups', {}).values())
+        rollup_keys = {}
+        if rollups is None:
+            rollups = compute_rollups(pd.DataFrame(columns=outputCol), pd.Series(dtype=object))
+        for name, df_rollup in rollups.items():
+            rollup_keys[name] = f"{prefix}rollups/{name}-{uuid.uuid4().hex}.parquet"
+            objects[rollup_keys[name]] = to_parquet_bytes(df_rollup)
+
+        old_keys += [manifest['categorizer']] if 'categorizer' in manifest else []
+        categorizer_key = f"{prefix}categorizer/index-{uuid.uuid4().hex}.parquet"
+        objects[categorizer_key] = to_parquet_bytes(index)
+
+        # upload the new objects, then the manifest that references them
+        put_objects(s3_client, bucket, objects)
+        # the replaced objects are retired, not deleted: a reader may still hold the previous
+        # manifest, they are deleted by the first compaction after COMPACT_RETIRE_SECONDS
+        now = time.time()
+        retired = manifest.get('retired', [])
+        expired = [group for group in retired if now - group['at'] >= COMPACT_RETIRE_SECONDS]
+        retired = [group for group in retired if now - group['at'] < COMPACT_RETIRE_SECONDS]
+        compacted = {'version': manifest['version'] + 1, 'partitions': partitions, 'segments': [],
+                     'rollups': rollup_keys, 'categorizer': categorizer_key, 'duplicates': duplicates,
+                     'retired': retired + [{'at': now, 'keys': old_keys}]}
+        if not write_manifest(s3_client, bucket, prefix, compacted, etag):
+            print(f"Compaction of {bucket}/{prefix} raced with a save, retrying later")
+            delete_objects(s3_client, bucket, objects.keys())
+            return False
+        print(f"{len(manifest['segments'])} segments compacted into {bucket}/{prefix}")
+
+        # no manifest written for COMPACT_RETIRE_SECONDS points to the expired objects
+        delete_objects(s3_client, bucket, [key for group in expired for key in group['keys']])
+        return True
+    finally:
+        _compaction_lock.release()
+
+
+def migrate_csv_output(s3_client, bucket, csv_key, prefix):
+    """
+    One-shot migration of the legacy combined_transactions.csv to the partitioned store.
+
+    The legacy output was read with unparseable dates coerced, so it may hold such rows:
+    they are kept in the UNKNOWN_MONTH partition. The rows with an invalid amount or type
+    are reported and skipped.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    csv_key (str): The key of the legacy CSV output.
+    prefix (str): The prefix of the output store, ending with '/'.
+
+    Returns:
+    int: The number of migrated rows.
+    """
+    if not is_empty(read_manifest_for_update(s3_client, bucket, prefix)[0]):
+        raise ValueError(f"{bucket}/{prefix} already holds data, refusing to migrate over it")
+
+    obj = s3_client.get_object(Bucket=bucket, Key=csv_key)
+    df = pd.read_csv(BytesIO(obj['Body'].read()), index_col=False)
+    problems = transaction_problems(typed_transactions(df), unknown_dates=True)
+    invalid = pd.Series(False, index=df.index)
+    for problem, mask in problems.items():
+        if mask.any():
+            print(f"Skipping {mask.sum()} rows of {bucket}/{csv_key} with an {problem}")
+            invalid |= mask
+    df = df[~invalid]
+    append_output_data(df, s3_client, bucket, prefix, unknown_dates=True)
+    compact_output(s3_client, bucket, prefix, force=True)
+    return len(df)
@@ -1,29 +1,84 @@
-import boto3
-import streamlit as st
-from utils import BUCKET_NAME, FILE_KEY_BUDGET, load_budget_sheet
-
-st.set_page_config(page_title="Budget", page_icon=":moneybag:", layout="wide")
-st.markdown("# Budget 2025")
-st.sidebar.header("Budget 2025")
-
-if "password_correct" not in st.session_state or st.session_state["password_correct"] is  False:
-    st.info("Please enter the password in the homepage to access the data.")
-    st.stop()
-
-# Access secrets
-aws_access_key_id = st.secrets["credentials"]["aws_access_key_id"]
-aws_secret_access_key = st.secrets["credentials"]["aws_secret_access_key"]
-
-
-
-
-# Initialize a session using Amazon S3
-s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
-
-# Load data
-df_sub_cat = load_budget_sheet(s3, BUCKET_NAME, FILE_KEY_BUDGET,"Détails budget")
-
-# Display the data in Streamlit
-st.title('Repartition des dépenses')
-
-st.dataframe(df_sub_cat)
+import streamlit as st
+from botocore.exceptions import ClientError
+
+from storage import get_storage_client
+from tenancy import budget_years, current_tenant, select_year, tenant_keys, years_of
+from utils import BUCKET_NAME, load_budget_sheet
+from output_store import read_rollups
+from tracing import display_trace_panel, span, start_trace
+from variance import category_variance, compute_variance
+
+st.set_page_config(page_title="Budget", page_icon=":moneybag:", layout="wide")
+start_trace('budget')
+st.sidebar.header("Budget")
+
+if "password_correct" not in st.session_state or st.session_state["password_correct"] is  False:
+    st.info("Please enter the password in the homepage to access the data.")
+    st.stop()
+
+# Access secrets
+aws_access_key_id = st.secrets["credentials"]["aws_access_key_id"]
+aws_secret_access_key = st.secrets["credentials"]["aws_secret_access_key"]
+
+is_prod = True if st.secrets["env"]["production_env"] == "1" else False
+
+ENV_FOLDER = 'prod' if is_prod else 'local'
+# storage keys of the household of the session
+FILE_KEY_OUTPUT = tenant_keys(ENV_FOLDER, current_tenant())['output']
+
+
+# Get the storage client shared by all sessions (S3, or the local/memory backend)
+s3 = get_storage_client(aws_access_key_id, aws_secret_access_key)
+
+# Load data, the budget is the workbook of the selected year
+with span('read_rollups'):
+    rollups = read_rollups(s3, BUCKET_NAME, FILE_KEY_OUTPUT)
+all_months = [] if rollups is None else list(rollups['month_sub_category']['Month'].unique())
+year = select_year(years_of(all_months, budget_years(s3, BUCKET_NAME, current_tenant())))
+months = sorted([month for month in all_months if month[:4] == str(year)], reverse=True)
+st.markdown(f"# Budget {year}")
+FILE_KEY_BUDGET = tenant_keys(ENV_FOLDER, current_tenant(), year)['budget']
+with span('load_budget'):
+    try:
+        df_sub_cat = load_budget_sheet(s3, BUCKET_NAME, FILE_KEY_BUDGET,"Détails budget")
+    except ClientError:
+        st.warning(f'No budget for {year}, please upload it to {FILE_KEY_BUDGET}.')
+        display_trace_panel()
+        st.stop()
+
+# Compare the budget with the actual expenses
+st.title('Budget vs dépenses')
+variance = None
+if rollups is None:
+    st.warning('No data available. Please import transactions first.')
+elif not months:
+    st.warning(f'No transactions in {year}.')
+else:
+    month_sub_category = rollups['month_sub_category']
+    selected_month = st.selectbox('Select a Month', months)
+    with span('variance'):
+        try:
+            variance = compute_variance(df_sub_cat, month_sub_category, selected_month[:4])
+        except ValueError as e:
+            # the budget sheet is still shown below
+            st.warning(str(e))
+
+if variance is not None:
+    variance_month = variance[variance['Month'] == selected_month].drop(columns='Month')
+    by_category = category_variance(variance)
+    by_category = by_category[by_category['Month'] == selected_month].drop(columns='Month')
+
+    money = {col: st.column_config.NumberColumn(col, format='%.2f $') for col in
+             ['Budget', 'Actual', 'Variance', 'YTD Budget', 'YTD Actual', 'YTD Variance']}
+    st.markdown('## Par catégorie')
+    st.dataframe(by_category, column_config=money, hide_index=True)
+    st.markdown('## Par ligne de budget')
+    st.dataframe(variance_month, column_config=money, hide_index=True)
+
+# Display the data in Streamlit
+st.title('Repartition des dépenses')
+
+st.dataframe(df_sub_cat)
+
+# End the trace of this rerun, and show the profiling panel when PERF_TRACE is set
+display_trace_panel()
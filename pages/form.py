@@ -1,11 +1,16 @@
-import boto3
 import streamlit as st
-import pandas as pd
+from botocore.exceptions import ClientError
 
-from utils import display_category_form, listRBCCol, parse_rbc_data, FILE_KEY_BUDGET, BUCKET_NAME, set_category, \
-    stage_data, listNBCCol, parse_bnc_data, listNBCColCredit, parse_bnc_credit_data, listScotiaCol, parse_scotia_data
+from jobs import JOB_QUERY_PARAM, activeStatuses, consume_job, display_job_progress, get_job, job_owner, pending_job, \
+    submit_job
+from output_store import list_months, read_manifest
+from storage import get_storage_client
+from tenancy import budget_years, current_tenant, select_year, tenant_keys, years_of
+from tracing import display_trace_panel, span, start_trace
+from utils import display_category_form, BUCKET_NAME, set_category, detect_account, ingest_transactions
 
 st.set_page_config(page_title="New transactions", page_icon=":form:", layout="wide")
+start_trace('form')
 st.markdown("# Import new transactions")
 st.sidebar.header("Import")
 
@@ -22,77 +27,134 @@ aws_secret_access_key = st.secrets["credentials"]["aws_secret_access_key"]
 is_prod = True if st.secrets["env"]["production_env"] == "1" else False
 
 ENV_FOLDER = 'prod' if is_prod else 'local'
+TENANT = current_tenant()
+OWNER = job_owner()
 
-bucket_name = "wikomexpensetracker"
 file_rbc_account = "rbc_account.csv"
 file_bnc_checking_009 = "bnc_check_009.csv"
 file_bnc_mastercard_2110 = "bnc_mastercard_2110.csv"
 file_scotia_checking_2080 = "scotia_checking_2080.csv"
-FILE_OUTPUT_TRANSFORMED = "combined_transactions.csv"
+# build output key file, under the storage keys of the household of the session
+output_file = tenant_keys(ENV_FOLDER, TENANT)['output']
+staging_folder = tenant_keys(ENV_FOLDER, TENANT)['staging']
 
 
 
-# Initialize a session using Amazon S3
-s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+# Get the storage client shared by all sessions (S3, or the local/memory backend)
+s3 = get_storage_client(aws_access_key_id, aws_secret_access_key)
+
+# The categories are the ones of the budget workbook of the selected year
+year = select_year(years_of(list_months(read_manifest(s3, BUCKET_NAME, output_file)),
+                            budget_years(s3, BUCKET_NAME, TENANT)))
+FILE_KEY_BUDGET = tenant_keys(ENV_FOLDER, TENANT, year)['budget']
+try:
+    categories, category_dict = set_category(s3, BUCKET_NAME, FILE_KEY_BUDGET)
+except ClientError:
+    st.error(f'No budget for {year}, please upload it to {FILE_KEY_BUDGET}.')
+    display_trace_panel()
+    st.stop()
 
 # Initialize session state for storing form data
 if 'form_data' not in st.session_state:
     st.session_state.form_data = None
 
-def parse_transaction(account, uploaded_file):
-    
-    if account == 'RBC':
-        df = pd.read_csv(uploaded_file, names=listRBCCol, index_col=False, skiprows=1)
-        # stage data
-        staging_rbc_cheque_object = ENV_FOLDER + '/staging/' + file_rbc_account
-        stage_data(df, s3, BUCKET_NAME, staging_rbc_cheque_object)
-        return parse_rbc_data(df)
-    elif account == 'NBC Cheque':
-        df = pd.read_csv(uploaded_file, names=listNBCCol, index_col=False,sep=';', skiprows=1)
-        # stage data
-        staging_nbc_cheque_object = ENV_FOLDER + '/staging/' + file_bnc_checking_009
-        stage_data(df, s3, BUCKET_NAME, staging_nbc_cheque_object)
-        return parse_bnc_data(df)
-    elif account == 'NBC Credit':
-        df = pd.read_csv(uploaded_file, names=listNBCColCredit, index_col=False,sep=';', skiprows=1)
-        # stage data
-        staging_nbc_credit_object = ENV_FOLDER + '/staging/' + file_bnc_mastercard_2110
-        stage_data(df, s3, BUCKET_NAME, staging_nbc_credit_object)
-        return parse_bnc_credit_data(df)
-    elif account == 'Scotia':
-        df = pd.read_csv(uploaded_file, names=listScotiaCol, index_col=False, skiprows=1)
-        # stage data
-        staging_scotia_object = ENV_FOLDER + '/staging/' + file_scotia_checking_2080
-        stage_data(df, s3, BUCKET_NAME, staging_scotia_object)
-        return parse_scotia_data(df, 'Checking')
-    else:
-        pass
-
+# staging object of every account
+staging_objects = {
+    'RBC': staging_folder + file_rbc_account,
+    'NBC Cheque': staging_folder + file_bnc_checking_009,
+    'NBC Credit': staging_folder + file_bnc_mastercard_2110,
+    'Scotia': staging_folder + file_scotia_checking_2080,
+}
 
+AUTO_DETECT = 'Auto-detect'
 
 
-# Create a form to upload a file. The form should has a dropdown list to select the account
+# Create a form to upload the files. The account of every file is detected from its header unless one is selected
 
 with st.form(key=f'form_import'):
-    account = st.selectbox('Compte', ['RBC', 'NBC Cheque', 'NBC Credit', 'Scotia'])
-    uploaded_file = st.file_uploader("Choose a file", type=['csv', 'xlsx'])
+    account = st.selectbox('Compte', [AUTO_DETECT] + list(staging_objects.keys()))
+    uploaded_files = st.file_uploader("Choose files", type=['csv', 'xlsx'], accept_multiple_files=True)
     submit_button = st.form_submit_button(label='Submit')
-    if submit_button:
-        st.write(f'You selected {account}')
-        st.write(f'You uploaded {uploaded_file.name}')
-        if uploaded_file is not None:
-            (ret, parsed_data) = parse_transaction(account, uploaded_file)
-            if ret != 100:
-                # generate some errors and ask to verify file
-                st.text("Error happened")
-            else:             
-                # store form data in session
-                st.session_state.form_data = parsed_data
-        
+    if submit_button and uploaded_files:
+        files = []
+        for uploaded_file in uploaded_files:
+            data = uploaded_file.getvalue()
+            file_account = detect_account(data) if account == AUTO_DETECT else account
+            if file_account is None:
+                st.error(f"Can't detect the account of {uploaded_file.name}, please select it")
+            else:
+                st.write(f'{uploaded_file.name}: {file_account}')
+                files.append((uploaded_file.name, file_account, data))
+
+        if files:
+            # imported in the background, the job id in the URL survives a refresh of the page
+            st.query_params[JOB_QUERY_PARAM] = submit_job(TENANT, OWNER, 'ingest', ingest_transactions, files,
+                                                          s3, BUCKET_NAME, staging_objects, category_dict, output_file)
+
+
+# Follow the import or save job of the page, the latest one when the URL doesn't name one
+# (jobs of other households and other browsers are ignored)
+job_id = st.query_params.get(JOB_QUERY_PARAM) or pending_job(TENANT, OWNER, ['ingest', 'save'])
+job = get_job(job_id) if job_id else None
+if job is not None and (job.get('tenant') != TENANT or job.get('owner') != OWNER):
+    job = None
+saving = False
+if job is not None and job['status'] in activeStatuses:
+    saving = job['kind'] == 'save'
+    st.query_params[JOB_QUERY_PARAM] = job_id
+    display_job_progress(job_id)
+elif job is not None:
+    status, result = consume_job(job_id)
+    st.query_params.pop(JOB_QUERY_PARAM, None)
+    if status == 'consumed':
+        # read by another page of the browser
+        st.info(f"The result of the {job['kind']} was already read.")
+    elif status != 'done':
+        st.error(f"{job['kind'].capitalize()} failed: {job['error']}")
+    elif job['kind'] == 'ingest':
+        st.session_state.import_report = result
+        if not result['data'].empty:
+            # store form data in session
+            st.session_state.form_data = result['data']
+    elif result['duplicates'].empty:
+        st.session_state.form_data = None
+        st.success(f"{result['saved']} transactions saved successfully.")
+    else:
+        duplicates = result['duplicates']
+        if st.session_state.form_data is not None:
+            df = st.session_state.form_data
+            if 'Duplicate' not in df.columns:
+                df['Duplicate'] = 0.0
+            df.loc[duplicates.index, 'Duplicate'] = duplicates
+            df.loc[duplicates.index, 'To Ignore'] = True
+        st.warning(f'{len(duplicates)} transactions were saved in the meantime and are now marked to '
+                   f'ignore, please review them before saving.')
+elif job_id:
+    st.query_params.pop(JOB_QUERY_PARAM, None)
+
+# Report of the last import
+report = st.session_state.get('import_report')
+if report is not None:
+    for name, file_account, ret, file_stats in report['results']:
+        if ret != 100:
+            # generate some errors and ask to verify file
+            st.error(f"Error {ret} while parsing {name}, please verify it is a {file_account} export")
+        else:
+            st.write(f"{name}: {file_stats['rows']} transactions ({file_stats['staged']} newly staged) "
+                     f"in {file_stats['seconds']:.1f}s")
+    stats = report['stats']
+    st.write(f"Imported {stats['rows']} transactions in {stats['seconds']:.1f}s, "
+             f"{stats['rows'] / max(stats['seconds'], 1e-6):,.0f} rows/s, "
+             f"estimated peak memory {stats['peak_memory'] / 1e6:.1f} MB")
+    if not report['data'].empty:
+        st.write(f"{(report['data']['Confidence'] > 0).sum()} transactions categorized from the history, "
+                 f"{(report['data']['Duplicate'] > 0).sum()} already saved and marked to ignore")
+
 
 if st.session_state.form_data is not None:
     st.write("run the transaction logs")
-    catogories, sub_categories = set_category(s3,BUCKET_NAME, FILE_KEY_BUDGET)
-    # build output key file
-    output_file = ENV_FOLDER + '/output/' + FILE_OUTPUT_TRANSFORMED
-    display_category_form(st.session_state.form_data, catogories, sub_categories,s3,output_file)
+    with span('render.category_form'):
+        display_category_form(st.session_state.form_data, categories, category_dict,s3,output_file, saving)
+
+# End the trace of this rerun, and show the profiling panel when PERF_TRACE is set
+display_trace_panel()
@@ -0,0 +1,177 @@
+# SQL query layer over the output store, run by an embedded DuckDB
+#
+# Queries run on a 'transactions' view of the store (typed like schema.py, amounts in cents),
+# with a Month (yyyy-mm) column. Only the month parts and segments of the requested months
+# are scanned, and results are cached per query, parameters and data version (the manifest
+# version), in the memory budget of the tenant owning the store (see tenancy.py).
+from io import BytesIO
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from output_store import UNKNOWN_MONTH, list_months, read_parquet_tables
+from s3_cache import is_remote
+from schema import is_typed, outputCol, typed_table, typed_transactions
+from tenancy import tenant_cache
+from tracing import count, span
+
+# aggregations of the home page
+monthlySummarySql = """
+    SELECT Month, Type, SUM(Amount) / 100 AS Amount FROM transactions
+    WHERE Month <> 'unknown' GROUP BY Month, Type ORDER BY Month, Type
+"""
+categoryDistributionSql = """
+    SELECT Category, SUM(Amount) / 100 AS Amount FROM transactions
+    WHERE Month = ? AND Type = 'expense' GROUP BY Category ORDER BY Amount
+"""
+subCategoryDistributionSql = """
+    SELECT "Sub Category", SUM(Amount) / 100 AS Amount FROM transactions
+    WHERE Month = ? AND Type = 'expense' AND Category = ? GROUP BY "Sub Category" ORDER BY "Sub Category"
+"""
+
+
+# transactions explorer
+explorerSortCol = ['Date', 'Amount', 'Account', 'Category', 'Sub Category', 'Description']
+explorerSelectSql = """
+    SELECT strftime("Date", '%Y-%m-%d') AS "Date", Name, Account, Type, Category, "Sub Category",
+           Amount / 100 AS Amount, Description
+    FROM transactions
+"""
+explorerOptionsSql = """
+    SELECT DISTINCT Account, Category FROM transactions ORDER BY Account, Category
+"""
+EXPORT_BATCH_ROWS = 50_000
+
+
+def store_keys(manifest, months):
+    """
+    Get the keys of the month parts and segments holding the transactions of some months.
+    """
+    months = set(months)
+    keys = [partition['key'] for month, partition in sorted(manifest['partitions'].items()) if month in months]
+    keys += [segment['key'] for segment in manifest['segments'] if months.intersection(segment['months'])]
+    return keys
+
+
+def register_transactions(con, s3_client, bucket, manifest, months):
+    """
+    Create the 'transactions' view of some months of the store in a DuckDB connection.
+
+    Parameters:
+    con (duckdb.DuckDBPyConnection): The connection.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    manifest (dict): The manifest of the store.
+    months (list): The months (yyyy-mm) to scan.
+    """
+    keys = store_keys(manifest, months)
+    local = not is_remote(s3_client) and hasattr(s3_client, 'local_path')
+    paths = [s3_client.local_path(bucket, key) for key in keys] if local else []
+    if keys and local and all(is_typed(pq.read_schema(path)) for path in paths):
+        # local backend, DuckDB scans the files
+        con.read_parquet(paths, union_by_name=True).create_view('source')
+    else:
+        tables = read_parquet_tables(s3_client, bucket, keys)
+        tables = [typed_table(tables[key]) for key in keys] or [
+            pa.Table.from_pandas(typed_transactions(pd.DataFrame(columns=outputCol)), preserve_index=False)]
+        con.register('source', pa.concat_tables(tables, promote_options='permissive'))
+
+    # segments may hold rows already in the month parts, and rows of other months
+    # (views can't take parameters, months are yyyy-mm strings from the manifest)
+    has_segments = any(set(months).intersection(segment['months']) for segment in manifest['segments'])
+    month_list = ', '.join("'" + month.replace("'", "''") + "'" for month in sorted(months))
+    con.execute(f"""
+        CREATE VIEW transactions AS SELECT * FROM (
+            SELECT *, coalesce(strftime("Date", '%Y-%m'), '{UNKNOWN_MONTH}') AS Month
+            FROM {'(SELECT DISTINCT * FROM source)' if has_segments else 'source'}
+        ) WHERE Month IN ({month_list or 'NULL'})
+    """)
+
+
+@tenant_cache('prefix', version_arg='version')
+def query_transactions(_s3_client, bucket, prefix, _manifest, version, sql, params=(), months=None):
+    """
+    Run a SQL query on the transactions of the output store.
+
+    Parameters:
+    _s3_client (boto3.client): The S3 client object (not hashed).
+    bucket (str): The name of the S3 bucket.
+    prefix (str): The prefix of the output store, ending with '/'.
+    _manifest (dict): The manifest of the store (not hashed).
+    version (int): The version of the manifest, part of the cache key.
+    sql (str): The query, on the 'transactions' view.
+    params (tuple): The parameters of the query.
+    months (tuple): The months (yyyy-mm) the query needs. All months when None.
+
+    Returns:
+    pandas.DataFrame: The result of the query.
+    """
+    if months is None:
+        months = list_months(_manifest)
+    count('query_cache_misses')
+    with duckdb.connect() as con:
+        with span('query.scan', months=len(months)):
+            register_transactions(con, _s3_client, bucket, _manifest, months)
+        with span('query.execute', sql=' '.join(sql.split())[:80]):
+            return con.execute(sql, list(params)).df()
+
+
+def explorer_filter(start, end, accounts, categories, text):
+    """
+    Build the WHERE clause of the transactions explorer.
+
+    Parameters:
+    start (datetime.date): The first date.
+    end (datetime.date): The last date.
+    accounts (list): The accounts to keep. All accounts when empty.
+    categories (list): The categories to keep. All categories when empty.
+    text (str): Text searched in the description and the bank name, case insensitive.
+
+    Returns:
+    tuple: The clause and its parameters.
+    """
+    clauses = ['"Date" BETWEEN ? AND ?']
+    params = [start, end]
+    if accounts:
+        clauses.append('list_contains(?, Account)')
+        params.append(list(accounts))
+    if categories:
+        clauses.append('list_contains(?, Category)')
+        params.append(list(categories))
+    if text:
+        clauses.append("(contains(lower(Description), lower(?)) OR contains(lower(Name), lower(?)))")
+        params += [text, text]
+    return 'WHERE ' + ' AND '.join(clauses), tuple(params)
+
+
+def explorer_page_sql(where, sort_col, descending, page_size, page):
+    """
+    Build the query of one page of the transactions explorer, sorted on one column.
+    """
+    if sort_col not in explorerSortCol:
+        raise ValueError(f"Can't sort on {sort_col}")
+    order = 'DESC' if descending else 'ASC'
+    return (f'{explorerSelectSql} {where} ORDER BY "{sort_col}" {order}, "Date" {order}, Description '
+            f'LIMIT {int(page_size)} OFFSET {(int(page) - 1) * int(page_size)}')
+
+
+def export_csv(s3_client, bucket, manifest, where, params, months):
+    """
+    Export the transactions matching a filter of the explorer as CSV. Rows are streamed
+    from DuckDB in batches into the CSV writer, without a DataFrame of the whole result.
+
+    Returns:
+    bytes: The CSV content.
+    """
+    buffer = BytesIO()
+    with duckdb.connect() as con:
+        register_transactions(con, s3_client, bucket, manifest, months)
+        reader = con.execute(f'{explorerSelectSql} {where} ORDER BY "Date"', list(params)).fetch_record_batch(
+            EXPORT_BATCH_ROWS)
+        with pa_csv.CSVWriter(buffer, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+    return buffer.getvalue()
@@ -0,0 +1,141 @@
+# Local disk cache for S3 objects, revalidated with the object's ETag
+import json
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+from botocore.exceptions import ClientError
+
+from tracing import count
+
+CACHE_DIR = os.environ.get('S3_CACHE_DIR', '.s3_cache')
+CACHE_MAX_BYTES = int(os.environ.get('S3_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+INDEX_NAME = 'index.json'
+
+cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+_lock = threading.Lock()
+# (bucket/key) -> {'etag', 'size', 'file'}, least recently used first
+_index = None
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        _index = OrderedDict()
+        try:
+            with open(os.path.join(CACHE_DIR, INDEX_NAME)) as f:
+                for name, entry in json.load(f):
+                    if os.path.exists(os.path.join(CACHE_DIR, entry['file'])):
+                        _index[name] = entry
+        except (OSError, ValueError):
+            pass
+    return _index
+
+
+def _save_index():
+    tmp_path = os.path.join(CACHE_DIR, INDEX_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(list(_index.items()), f)
+    os.replace(tmp_path, os.path.join(CACHE_DIR, INDEX_NAME))
+
+
+def _read_entry(entry):
+    with open(os.path.join(CACHE_DIR, entry['file']), 'rb') as f:
+        return f.read()
+
+
+def _drop_entry(name):
+    entry = _index.pop(name, None)
+    if entry is not None:
+        try:
+            os.remove(os.path.join(CACHE_DIR, entry['file']))
+        except OSError:
+            pass
+
+
+def _store_entry(name, etag, data):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    file_name = sha1(name.encode('utf-8')).hexdigest()
+    tmp_path = os.path.join(CACHE_DIR, file_name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, os.path.join(CACHE_DIR, file_name))
+    _index[name] = {'etag': etag, 'size': len(data), 'file': file_name}
+    _index.move_to_end(name)
+
+    # evict the least recently used objects until the cache fits in its budget
+    total_size = sum(entry['size'] for entry in _index.values())
+    while total_size > CACHE_MAX_BYTES and len(_index) > 1:
+        oldest = next(iter(_index))
+        total_size -= _index[oldest]['size']
+        _drop_entry(oldest)
+        cache_stats['evictions'] += 1
+    _save_index()
+
+
+def _is_not_modified(error):
+    return (error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+            or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304)
+
+
+def is_remote(s3_client):
+    # the local and memory storage backends don't go through the cache
+    return getattr(s3_client, 'is_remote', True)
+
+
+def get_object_bytes(s3_client, bucket, file_key, immutable=False):
+    """
+    Get the content of an S3 object, served from the local disk cache when it didn't change.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    file_key (str): The key (path) of the file in the S3 bucket.
+    immutable (bool): The object is never rewritten under the same key, a cached copy
+        is served without asking S3.
+
+    Returns:
+    bytes: The content of the object.
+
+    Raises:
+    ClientError: The object can't be read from S3.
+    """
+    if not is_remote(s3_client):
+        return s3_client.get_object(Bucket=bucket, Key=file_key)['Body'].read()
+
+    name = f"{bucket}/{file_key}"
+    with _lock:
+        entry = _load_index().get(name)
+        if entry is not None and immutable:
+            _index.move_to_end(name)
+            cache_stats['hits'] += 1
+            count('s3_cache_hits')
+            return _read_entry(entry)
+
+    try:
+        if entry is not None:
+            obj = s3_client.get_object(Bucket=bucket, Key=file_key, IfNoneMatch=entry['etag'])
+        else:
+            obj = s3_client.get_object(Bucket=bucket, Key=file_key)
+    except ClientError as e:
+        if entry is None or not _is_not_modified(e):
+            with _lock:
+                _drop_entry(name)
+            raise
+        with _lock:
+            if name in _index:
+                _index.move_to_end(name)
+                cache_stats['hits'] += 1
+                count('s3_cache_hits')
+                return _read_entry(entry)
+        # evicted by another session in the meantime
+        obj = s3_client.get_object(Bucket=bucket, Key=file_key)
+
+    data = obj['Body'].read()
+    with _lock:
+        cache_stats['misses'] += 1
+        count('s3_cache_misses')
+        _store_entry(name, obj['ETag'], data)
+    return data
@@ -0,0 +1,145 @@
+# Typed schema of the consolidated transactions
+#
+# In memory and in the output store, transactions have a datetime Date, categoricals for
+# the low-cardinality columns and integer cents for the amount. Stores written before the
+# schema (string dates, float amounts in dollars) are converted when read. The unit of an
+# amount comes from its source, not its dtype: parsed and legacy transactions are in dollars
+# (whole dollar amounts may be integers), only tables of the store typed by the schema are in
+# cents (see is_typed).
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import CategoricalDtype, is_datetime64_any_dtype
+
+DATE_FORMAT = '%Y-%m-%d'
+transactionTypes = ['expense', 'credit']
+
+# cleanedCol without the 'To Ignore' flag, which is dropped before saving
+outputCol = ['Date', 'Name', 'Account', 'Type', 'Category',
+             'Sub Category', 'Amount', 'Description']
+# low-cardinality columns, held as categoricals
+categoryCol = ['Name', 'Account', 'Type', 'Category', 'Sub Category']
+
+
+def parse_dates(dates):
+    """
+    Parse transaction dates with the fixed DATE_FORMAT, inferring the format only for the
+    dates written otherwise.
+
+    Parameters:
+    dates (pandas.Series): The dates, as strings or datetimes.
+
+    Returns:
+    pandas.Series: The datetime64 dates, NaT when a date can't be parsed.
+    """
+    if is_datetime64_any_dtype(dates):
+        return dates
+    parsed = pd.to_datetime(dates, format=DATE_FORMAT, errors='coerce')
+    other = parsed.isna() & dates.notna()
+    if other.any():
+        parsed[other] = pd.to_datetime(dates[other].astype(str), format='mixed', errors='coerce')
+    return parsed
+
+
+def to_cents(amounts):
+    """
+    Convert amounts in dollars (numbers or strings) to integer cents.
+    """
+    return (pd.to_numeric(amounts, errors='coerce') * 100).round().astype('Int64')
+
+
+def to_dollars(cents):
+    return cents.astype(float) / 100
+
+
+def typed_transactions(df, cents=False):
+    """
+    Give transactions the dtypes of the schema, in the outputCol order.
+
+    Parameters:
+    df (pandas.DataFrame): The transactions, typed or in the legacy layout (string dates,
+        amounts in dollars).
+    cents (bool): The amounts are already in cents, for transactions read from typed tables
+        of the store.
+
+    Returns:
+    pandas.DataFrame: The typed transactions.
+    """
+    df = df[outputCol].copy()
+    df['Date'] = parse_dates(df['Date'])
+    df['Amount'] = df['Amount'].astype('Int64') if cents else to_cents(df['Amount'])
+    for col in categoryCol + ['Description']:
+        if not isinstance(df[col].dtype, CategoricalDtype):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+            if col in categoryCol:
+                df[col] = df[col].astype('category')
+    return df
+
+
+def is_typed(schema):
+    # parts and segments written before the schema hold string dates and amounts in dollars
+    return pa.types.is_integer(schema.field('Amount').type)
+
+
+def typed_table(table):
+    """
+    Give an Arrow table of transactions the types of the schema.
+    """
+    if is_typed(table.schema):
+        return table
+    return pa.Table.from_pandas(typed_transactions(table.to_pandas()), preserve_index=False)
+
+
+def concat_transactions(frames):
+    """
+    Concatenate typed transactions. pandas falls back to object columns when categoricals
+    have different categories, they are made categorical again.
+    """
+    df = pd.concat(frames, ignore_index=True)
+    for col in categoryCol:
+        if not isinstance(df[col].dtype, CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def transaction_problems(typed, unknown_dates=False):
+    """
+    Find the invalid rows of typed transactions.
+
+    Parameters:
+    typed (pandas.DataFrame): The typed transactions.
+    unknown_dates (bool): Dates that can't be parsed are valid (kept in the unknown month).
+
+    Returns:
+    dict: The mask of the invalid rows, by problem.
+    """
+    problems = {} if unknown_dates else {'invalid date': typed['Date'].isna()}
+    problems['invalid amount'] = typed['Amount'].isna()
+    problems['invalid type'] = ~typed['Type'].isin(transactionTypes)
+    return problems
+
+
+def validate_transactions(df, unknown_dates=False):
+    """
+    Check transactions before they are written to the output store, and type them.
+
+    Parameters:
+    df (pandas.DataFrame): The transactions, in the cleanedCol or outputCol layout.
+    unknown_dates (bool): Accept dates that can't be parsed, for the migration of the legacy
+        output only.
+
+    Returns:
+    pandas.DataFrame: The typed transactions.
+
+    Raises:
+    ValueError: A column is missing, or some rows have an invalid date, amount or type.
+    """
+    missing = [col for col in outputCol if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    typed = typed_transactions(df)
+    problems = transaction_problems(typed, unknown_dates)
+    errors = [f"{problem} on {mask.sum()} rows" for problem, mask in problems.items() if mask.any()]
+    if errors:
+        raise ValueError(f"Invalid transactions: {', '.join(errors)}")
+    return typed
@@ -0,0 +1,339 @@
+# Storage backends (S3, local filesystem, memory) and concurrent multi-object transfers
+#
+# Every backend is a client with the subset of the boto3 S3 client API used by the app
+# (get_object, put_object, head_object, delete_object, list_objects_v2), so the rest of the
+# code takes any of them where it takes an S3 client.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from io import BytesIO
+
+import boto3
+import streamlit as st
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from s3_cache import get_object_bytes
+from tracing import TRACE_ENABLED, count, span, traced_submit
+
+# 's3', 'local' or 'memory'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 's3')
+# root directory of the buckets of the local backend
+STORAGE_ROOT = os.environ.get('STORAGE_ROOT', '.storage')
+
+# connections kept open by the shared client, also the number of concurrent transfers
+MAX_POOL_CONNECTIONS = 32
+s3Config = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    connect_timeout=5,
+    read_timeout=60,
+    tcp_keepalive=True,
+)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_POOL_CONNECTIONS, thread_name_prefix='s3')
+
+
+@st.cache_resource
+def get_s3_client(aws_access_key_id, aws_secret_access_key):
+    """
+    Get the S3 client shared by every session and rerun of the process.
+
+    boto3 clients are thread safe, so a single client and its connection pool serve
+    all the sessions.
+
+    Parameters:
+    aws_access_key_id (str): The AWS access key.
+    aws_secret_access_key (str): The AWS secret key.
+
+    Returns:
+    boto3.client: The S3 client object.
+    """
+    session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
+                                    aws_secret_access_key=aws_secret_access_key)
+    return session.client('s3', config=s3Config)
+
+
+def client_error(code, status, operation):
+    # the ClientError boto3 raises for the same failure
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+
+def check_conditions(etag, operation, if_match=None, if_none_match=None):
+    """
+    Raise the error of S3 when a conditional request doesn't match the current ETag of the object
+    (None when it doesn't exist).
+    """
+    if if_match is not None and (etag is None or if_match not in (etag, '*')):
+        raise client_error('PreconditionFailed', 412, operation)
+    if if_none_match is not None and etag is not None and if_none_match in (etag, '*'):
+        if operation == 'GetObject':
+            raise client_error('304', 304, operation)
+        raise client_error('PreconditionFailed', 412, operation)
+
+
+class LocalStorageClient:
+    """
+    Storage backend keeping every object in a file under root/bucket/key.
+
+    Objects are served straight from their file, without the local S3 cache, and
+    read_parquet memory maps Parquet files instead of copying them to memory first.
+    Conditional writes are atomic within the process.
+
+    Parameters:
+    root (str): The directory holding the buckets.
+    """
+    is_remote = False
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def local_path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None
+        return data, '"%s"' % md5(data).hexdigest()
+
+    def get_object(self, Bucket, Key, IfMatch=None, IfNoneMatch=None):
+        data, etag = self._read(self.local_path(Bucket, Key))
+        if data is None:
+            raise client_error('NoSuchKey', 404, 'GetObject')
+        check_conditions(etag, 'GetObject', IfMatch, IfNoneMatch)
+        return {'Body': BytesIO(data), 'ETag': etag, 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key):
+        data, etag = self._read(self.local_path(Bucket, Key))
+        if data is None:
+            raise client_error('404', 404, 'HeadObject')
+        return {'ETag': etag, 'ContentLength': len(data)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        data = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        path = self.local_path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file and rename it, so readers never see a half written object
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            try:
+                if IfMatch is not None or IfNoneMatch is not None:
+                    check_conditions(self._read(path)[1], 'PutObject', IfMatch, IfNoneMatch)
+            except ClientError:
+                os.remove(tmp_path)
+                raise
+            os.replace(tmp_path, path)
+        return {'ETag': '"%s"' % md5(data).hexdigest()}
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self.local_path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        contents = []
+        for dir_path, _, file_names in os.walk(bucket_root):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(path, bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix) and not file_name.endswith('.tmp'):
+                    contents.append({'Key': key, 'Size': os.path.getsize(path)})
+        contents.sort(key=lambda obj: obj['Key'])
+        return {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False}
+
+    def read_parquet(self, bucket, key):
+        """
+        Read a Parquet object through a memory map of its file.
+
+        Returns:
+        pyarrow.Table: The content of the object.
+        """
+        import pyarrow.parquet as pq
+
+        try:
+            return pq.read_table(self.local_path(bucket, key), memory_map=True)
+        except FileNotFoundError:
+            raise client_error('NoSuchKey', 404, 'GetObject') from None
+
+
+class MemoryStorageClient:
+    """
+    Storage backend keeping every object in memory, for development and tests.
+    """
+    is_remote = False
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def _get(self, bucket, key):
+        data = self._objects.get((bucket, key))
+        return data, None if data is None else '"%s"' % md5(data).hexdigest()
+
+    def get_object(self, Bucket, Key, IfMatch=None, IfNoneMatch=None):
+        data, etag = self._get(Bucket, Key)
+        if data is None:
+            raise client_error('NoSuchKey', 404, 'GetObject')
+        check_conditions(etag, 'GetObject', IfMatch, IfNoneMatch)
+        return {'Body': BytesIO(data), 'ETag': etag, 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key):
+        data, etag = self._get(Bucket, Key)
+        if data is None:
+            raise client_error('404', 404, 'HeadObject')
+        return {'ETag': etag, 'ContentLength': len(data)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        data = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        with self._lock:
+            check_conditions(self._get(Bucket, Key)[1], 'PutObject', IfMatch, IfNoneMatch)
+            self._objects[(Bucket, Key)] = data
+        return {'ETag': '"%s"' % md5(data).hexdigest()}
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self._objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        with self._lock:
+            objects = sorted((key, data) for (bucket, key), data in self._objects.items()
+                             if bucket == Bucket and key.startswith(Prefix))
+        contents = [{'Key': key, 'Size': len(data)} for key, data in objects]
+        return {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False}
+
+
+class TracedStorageClient:
+    """
+    Wrapper of a storage client timing every request in the trace of the current rerun,
+    and counting the requests and the bytes read and written. Used when PERF_TRACE is set.
+
+    Parameters:
+    client: The S3 client or storage backend to wrap.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        # is_remote, local_path... of the wrapped client
+        return getattr(self.client, name)
+
+    def get_object(self, **kwargs):
+        with span('storage.get_object', key=kwargs.get('Key')):
+            obj = self.client.get_object(**kwargs)
+            data = obj['Body'].read()
+        count('storage_requests')
+        count('bytes_read', len(data))
+        return {**obj, 'Body': BytesIO(data)}
+
+    def head_object(self, **kwargs):
+        with span('storage.head_object', key=kwargs.get('Key')):
+            count('storage_requests')
+            return self.client.head_object(**kwargs)
+
+    def put_object(self, **kwargs):
+        body = kwargs.get('Body', b'')
+        with span('storage.put_object', key=kwargs.get('Key')):
+            result = self.client.put_object(**kwargs)
+        count('storage_requests')
+        count('bytes_written', len(body.encode('utf-8') if isinstance(body, str) else body))
+        return result
+
+    def delete_object(self, **kwargs):
+        with span('storage.delete_object', key=kwargs.get('Key')):
+            count('storage_requests')
+            return self.client.delete_object(**kwargs)
+
+    def list_objects_v2(self, **kwargs):
+        with span('storage.list_objects', prefix=kwargs.get('Prefix')):
+            count('storage_requests')
+            return self.client.list_objects_v2(**kwargs)
+
+    def read_parquet(self, bucket, key):
+        with span('storage.read_parquet', key=key):
+            table = self.client.read_parquet(bucket, key)
+        count('bytes_read', table.nbytes)
+        return table
+
+
+@st.cache_resource
+def get_storage_client(aws_access_key_id, aws_secret_access_key):
+    """
+    Get the client of the storage backend selected by STORAGE_BACKEND, shared by every
+    session and rerun of the process.
+
+    Parameters:
+    aws_access_key_id (str): The AWS access key, for the S3 backend.
+    aws_secret_access_key (str): The AWS secret key, for the S3 backend.
+
+    Returns:
+    The boto3 S3 client, a LocalStorageClient or a MemoryStorageClient, wrapped in a
+    TracedStorageClient when PERF_TRACE is set.
+    """
+    if STORAGE_BACKEND == 'local':
+        client = LocalStorageClient(STORAGE_ROOT)
+    elif STORAGE_BACKEND == 'memory':
+        client = MemoryStorageClient()
+    elif STORAGE_BACKEND == 's3':
+        client = get_s3_client(aws_access_key_id, aws_secret_access_key)
+    else:
+        raise ValueError(f"Unknown storage backend {STORAGE_BACKEND}, expected s3, local or memory")
+    return TracedStorageClient(client) if TRACE_ENABLED else client
+
+
+def fetch_objects(s3_client, bucket, file_keys, immutable=False):
+    """
+    Get the content of several S3 objects concurrently, through the local disk cache.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    file_keys (list): The keys of the objects.
+    immutable (bool): The objects are never rewritten under the same key.
+
+    Returns:
+    dict: The content of every object, by key.
+
+    Raises:
+    ClientError: An object can't be read from S3.
+    """
+    file_keys = list(dict.fromkeys(file_keys))
+    futures = [traced_submit(_executor, get_object_bytes, s3_client, bucket, key, immutable=immutable)
+               for key in file_keys]
+    return {key: future.result() for key, future in zip(file_keys, futures)}
+
+
+def put_objects(s3_client, bucket, objects):
+    """
+    Upload several S3 objects concurrently.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    objects (dict): The content of every object, by key.
+    """
+    futures = [traced_submit(_executor, s3_client.put_object, Bucket=bucket, Key=key, Body=body)
+               for key, body in objects.items()]
+    for future in futures:
+        future.result()
+
+
+def delete_objects(s3_client, bucket, file_keys):
+    """
+    Delete several S3 objects concurrently.
+    """
+    futures = [traced_submit(_executor, s3_client.delete_object, Bucket=bucket, Key=key) for key in file_keys]
+    for future in futures:
+        future.result()
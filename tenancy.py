@@ -0,0 +1,315 @@
+# Tenants (households) and years, and the per-tenant in-process data cache
+#
+# Every household is a tenant with its own password, declared in the [tenants.<id>] sections
+# of the secrets. The storage keys of a tenant are under tenants/<id>/, the default tenant
+# (the [credentials] password) keeps the keys of the single household layout. A session
+# belongs to the tenant it logged in with, and has a selected year (budget workbook and
+# charts of that year).
+#
+# The data cached in memory (query results, budget workbooks, figures) is accounted per
+# tenant: each tenant has a budget of TENANT_CACHE_MAX_BYTES, and its least recently used
+# entries are evicted when it goes over it, without touching the entries of other tenants.
+# The entries computed from a version of some data (the manifest of an output store, the ETag
+# of a budget workbook) are dropped as soon as an entry of another version of it is cached.
+import functools
+import hmac
+import inspect
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from datetime import date
+
+import pandas as pd
+import streamlit as st
+
+DEFAULT_TENANT = 'default'
+TENANT_PREFIX = 'tenants/'
+TENANT_CACHE_MAX_BYTES = int(os.environ.get('TENANT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+BUDGET_KEY_FORMAT = 'shared/budget_{year}.xlsx'
+# memory of a plotly figure besides its JSON (trace and layout objects, validators...), about
+# 140 KB for the bar charts of the home page
+FIGURE_OVERHEAD_BYTES = 140_000
+
+tenantIdPattern = re.compile(r'^[a-z0-9][a-z0-9_-]*$')
+budgetKeyPattern = re.compile(r'^shared/budget_(\d{4})\.xlsx$')
+# session state kept when a session logs in with another tenant
+sessionKeepKeys = ['password', 'password_correct']
+
+
+def tenant_root(tenant):
+    """
+    The prefix of the storage keys of a tenant, '' for the default tenant.
+    """
+    if tenant == DEFAULT_TENANT:
+        return ''
+    if not tenantIdPattern.match(tenant):
+        raise ValueError(f"Invalid tenant id {tenant!r}, expected lower case letters, digits, '_' and '-'")
+    return f"{TENANT_PREFIX}{tenant}/"
+
+
+def tenant_of(key):
+    """
+    The tenant owning a storage key (or prefix).
+    """
+    if key.startswith(TENANT_PREFIX):
+        return key[len(TENANT_PREFIX):].split('/', 1)[0]
+    return DEFAULT_TENANT
+
+
+def tenant_keys(env_folder, tenant, year=None):
+    """
+    The storage keys of a tenant.
+
+    Parameters:
+    env_folder (str): 'prod' or 'local'.
+    tenant (str): The tenant id.
+    year (int): The selected year, for the budget workbook.
+
+    Returns:
+    dict: 'output', the prefix of the output store, 'staging', the prefix of the staging
+        objects, and 'budget', the key of the budget workbook of the year (None without a year).
+    """
+    root = tenant_root(tenant)
+    return {
+        'output': f"{root}{env_folder}/output/transactions/",
+        'staging': f"{root}{env_folder}/staging/",
+        'budget': root + BUDGET_KEY_FORMAT.format(year=year) if year is not None else None,
+    }
+
+
+def tenant_names():
+    """
+    The display name of every tenant of the secrets, by id.
+    """
+    names = {DEFAULT_TENANT: 'Default'} if 'password' in st.secrets.get('credentials', {}) else {}
+    for tenant, config in st.secrets.get('tenants', {}).items():
+        names[tenant] = config.get('name', tenant)
+    return names
+
+
+def authenticate(password):
+    """
+    Find the tenant of a password.
+
+    Returns:
+    str: The tenant id, None when the password is wrong.
+    """
+    for tenant, config in st.secrets.get('tenants', {}).items():
+        if hmac.compare_digest(password, config['password']):
+            return tenant
+    credentials = st.secrets.get('credentials', {})
+    if 'password' in credentials and hmac.compare_digest(password, credentials['password']):
+        return DEFAULT_TENANT
+    return None
+
+
+def start_tenant_session(tenant):
+    """
+    Attach the session to a tenant. The state of the session is cleared when it was
+    attached to another tenant.
+    """
+    if st.session_state.get('tenant') != tenant:
+        for key in list(st.session_state.keys()):
+            if key not in sessionKeepKeys:
+                del st.session_state[key]
+    st.session_state['tenant'] = tenant
+
+
+def current_tenant():
+    return st.session_state.get('tenant', DEFAULT_TENANT)
+
+
+def years_of(months, other_years=()):
+    """
+    The years of some months (yyyy-mm) and other years (budget workbooks...), most recent
+    first. The current year when there is none.
+    """
+    years = {int(month[:4]) for month in months if month[:4].isdigit()} | set(other_years)
+    return sorted(years, reverse=True) or [date.today().year]
+
+
+def budget_years(s3_client, bucket, tenant):
+    """
+    The years having a budget workbook for a tenant.
+    """
+    root = tenant_root(tenant)
+    objects = s3_client.list_objects_v2(Bucket=bucket, Prefix=root + 'shared/budget_').get('Contents', [])
+    matches = [budgetKeyPattern.match(obj['Key'][len(root):]) for obj in objects]
+    return [int(match.group(1)) for match in matches if match]
+
+
+def select_year(years):
+    """
+    Show the tenant of the session and the year selector in the sidebar.
+
+    The selected year is kept in the session across pages, the most recent year by default.
+
+    Parameters:
+    years (list): The years to choose from.
+
+    Returns:
+    int: The selected year.
+    """
+    years = sorted(set(years) | ({st.session_state['tenant_year']} if 'tenant_year' in st.session_state else set()),
+                   reverse=True)
+    year = st.session_state.get('tenant_year', years[0])
+    st.sidebar.caption(f"Foyer: {tenant_names().get(current_tenant(), current_tenant())}")
+    year = st.sidebar.selectbox('Year', years, index=years.index(year), key='year_select')
+    st.session_state['tenant_year'] = year
+    return year
+
+
+def cache_size(value):
+    """
+    Estimate the memory held by a cached value, in bytes.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, dict):
+        return sum(cache_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(cache_size(item) for item in value)
+    if hasattr(value, 'to_plotly_json'):
+        # plotly figure, its objects plus its data and layout
+        return FIGURE_OVERHEAD_BYTES + len(value.to_json())
+    return sys.getsizeof(value)
+
+
+def cache_copy(value):
+    # callers may modify the frames they get, like with st.cache_data
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    if isinstance(value, dict):
+        return {key: cache_copy(item) for key, item in value.items()}
+    return value
+
+
+def cache_key(value):
+    # lists (query parameters...) are frozen recursively, they can't be dict keys
+    if isinstance(value, (list, tuple)):
+        return tuple(cache_key(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, cache_key(item)) for key, item in value.items()))
+    if isinstance(value, set):
+        return frozenset(cache_key(item) for item in value)
+    return value
+
+
+class TenantCache:
+    """
+    In-memory LRU cache with a memory budget per tenant.
+
+    Parameters:
+    max_bytes (int): The memory budget of every tenant.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # tenant -> key -> (value, size, scope, version), least recently used first
+        self._entries = {}
+        self._sizes = {}
+        # (tenant, scope) -> version of the data of the entries of the scope
+        self._versions = {}
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, tenant, key):
+        """
+        Returns:
+        tuple: Whether the key is cached, and its value.
+        """
+        with self._lock:
+            entries = self._entries.get(tenant)
+            if entries is None or key not in entries:
+                self.stats['misses'] += 1
+                return False, None
+            entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return True, entries[key][0]
+
+    def put(self, tenant, key, value, size=None, scope=None, version=None):
+        """
+        Cache a value.
+
+        Parameters:
+        tenant (str): The tenant the entry is accounted to.
+        key (hashable): The key of the entry.
+        value: The value, its size is estimated by cache_size when size is None.
+        scope (hashable): The data the value is computed from (the prefix of an output store...).
+        version (hashable): The version of the data. The entries of the scope of other versions
+            are dropped, they won't be read again.
+        """
+        size = cache_size(value) if size is None else size
+        if size > self.max_bytes:
+            # would evict everything else of the tenant
+            return
+        with self._lock:
+            entries = self._entries.setdefault(tenant, OrderedDict())
+            if scope is not None and self._versions.get((tenant, scope), version) != version:
+                outdated = [entry_key for entry_key, entry in entries.items()
+                            if entry[2] == scope and entry[3] != version]
+                for entry_key in outdated:
+                    self._sizes[tenant] -= entries.pop(entry_key)[1]
+                self.stats['invalidations'] += len(outdated)
+            if scope is not None:
+                self._versions[(tenant, scope)] = version
+            if key in entries:
+                self._sizes[tenant] -= entries.pop(key)[1]
+            entries[key] = (value, size, scope, version)
+            self._sizes[tenant] = self._sizes.get(tenant, 0) + size
+            # evict the least recently used entries of the tenant until it fits in its budget
+            while self._sizes[tenant] > self.max_bytes:
+                _, evicted = entries.popitem(last=False)
+                self._sizes[tenant] -= evicted[1]
+                self.stats['evictions'] += 1
+
+    def usage(self):
+        """
+        Returns:
+        dict: The bytes and entries cached for every tenant.
+        """
+        with self._lock:
+            return {tenant: {'bytes': self._sizes.get(tenant, 0), 'entries': len(entries)}
+                    for tenant, entries in self._entries.items()}
+
+
+data_cache = TenantCache(TENANT_CACHE_MAX_BYTES)
+
+
+def tenant_cache(key_arg, version_arg=None):
+    """
+    Decorator caching the results of a function in data_cache, like st.cache_data: the
+    arguments are the cache key, except the ones starting with '_', and the cached frames
+    are copied for the caller. The entry is accounted to the tenant owning the storage key
+    passed as key_arg.
+
+    Parameters:
+    key_arg (str): The name of the argument holding a storage key (or prefix) of the tenant.
+    version_arg (str): The name of the argument holding the version of the data of the storage
+        key, caching a result drops the results of the other versions (see TenantCache.put).
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = (fn.__module__, fn.__qualname__) + tuple(
+                (name, cache_key(value)) for name, value in arguments.arguments.items() if not name.startswith('_'))
+            storage_key = arguments.arguments[key_arg]
+            tenant = tenant_of(storage_key)
+            hit, value = data_cache.get(tenant, key)
+            if not hit:
+                value = fn(*args, **kwargs)
+                if version_arg is None:
+                    data_cache.put(tenant, key, value)
+                else:
+                    data_cache.put(tenant, key, value, scope=storage_key, version=arguments.arguments[version_arg])
+            return cache_copy(value)
+        return wrapper
+    return decorator
@@ -0,0 +1,202 @@
+# Per-rerun performance traces: timing spans and counters, logged as JSON lines
+#
+# A page starts a trace at the top of its script and ends it at the bottom. In between,
+# span() times a block and count() adds to a counter of the trace (bytes read and written,
+# cache hits and misses). Every trace is appended to TRACE_LOG, and the sidebar panel shows
+# the slowest spans of the session. With PERF_TRACE unset no trace is started, and span()
+# and count() return after a single context variable lookup.
+import json
+import os
+import threading
+import time
+import uuid
+from contextvars import ContextVar, copy_context
+
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+TRACE_ENABLED = os.environ.get('PERF_TRACE', '0') == '1'
+TRACE_LOG = os.environ.get('PERF_TRACE_LOG', os.path.join('.perf', 'traces.jsonl'))
+# traces kept in the session for the sidebar panel
+SESSION_TRACES = 50
+
+# the trace of the running script, copied into the threads started with traced_submit
+_current_trace = ContextVar('current_trace', default=None)
+_log_lock = threading.Lock()
+
+
+class Trace:
+    """
+    The spans and counters of one rerun of a page.
+
+    Parameters:
+    page (str): The name of the page.
+    session_id (str): The id of the browser session.
+    """
+
+    def __init__(self, page, session_id):
+        self.id = uuid.uuid4().hex
+        self.page = page
+        self.session_id = session_id
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, seconds, attrs):
+        with self._lock:
+            self.spans.append({'name': name, 'start': round(start - self.start, 6),
+                               'seconds': round(seconds, 6), 'thread': threading.current_thread().name,
+                               **attrs})
+
+    def count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        return {'id': self.id, 'page': self.page, 'session': self.session_id,
+                'started_at': self.started_at, 'seconds': self.seconds,
+                'spans': self.spans, 'counters': self.counters}
+
+
+class _Span:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        attrs = self.attrs if exc_type is None else {**self.attrs, 'error': exc_type.__name__}
+        self.trace.add_span(self.name, self.start, time.perf_counter() - self.start, attrs)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name, **attrs):
+    """
+    Time a block of code in the trace of the current rerun, a no-op when no trace is running.
+
+        with span('query', sql=sql):
+            ...
+
+    Parameters:
+    name (str): The name of the span, dotted by area (storage.get_object, parse, render...).
+    attrs: Attributes logged with the span, JSON serializable.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _no_span
+    return _Span(trace, name, attrs)
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the trace of the current rerun, a no-op when no trace is running.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, value)
+
+
+def traced_submit(executor, fn, *args, **kwargs):
+    """
+    Submit a call to an executor thread, in the trace of the caller. Threads don't inherit
+    the context variables of the thread that submits the work.
+    """
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+def start_trace(page):
+    """
+    Start the trace of this rerun of a page. The trace of the previous rerun of the session is
+    ended first if the script stopped before ending it (st.stop, st.rerun, an exception).
+
+    Parameters:
+    page (str): The name of the page.
+    """
+    if not TRACE_ENABLED:
+        return
+    previous = st.session_state.get('_perf_trace')
+    if previous is not None and previous.seconds is None:
+        end_trace(previous)
+    ctx = get_script_run_ctx()
+    trace = Trace(page, ctx.session_id if ctx is not None else None)
+    st.session_state['_perf_trace'] = trace
+    _current_trace.set(trace)
+
+
+def end_trace(trace=None):
+    """
+    End the trace of this rerun, append it to TRACE_LOG and keep it for the session panel.
+
+    Parameters:
+    trace (Trace): The trace to end, the one of the current rerun when None.
+    """
+    trace = trace or _current_trace.get()
+    if trace is None or trace.seconds is not None:
+        return
+    trace.seconds = round(time.perf_counter() - trace.start, 6)
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+
+    session_traces = st.session_state.setdefault('_perf_traces', [])
+    session_traces.append(trace)
+    del session_traces[:-SESSION_TRACES]
+
+    line = json.dumps(trace.to_dict(), default=str)
+    try:
+        os.makedirs(os.path.dirname(TRACE_LOG) or '.', exist_ok=True)
+        with _log_lock, open(TRACE_LOG, 'a') as f:
+            f.write(line + '\n')
+    except OSError as e:
+        print(f'Error writing the performance trace to {TRACE_LOG}: {e}')
+
+
+def display_trace_panel():
+    """
+    End the trace of this rerun, and show the slowest spans and the counters of the session
+    in the sidebar when the Performance toggle is on.
+    """
+    if not TRACE_ENABLED:
+        return
+    end_trace()
+    if not st.sidebar.toggle('Performance', key='perf_panel'):
+        return
+    traces = st.session_state.get('_perf_traces', [])
+    if not traces:
+        return
+    last = traces[-1]
+    st.sidebar.caption(f'Last rerun of {last.page}: {last.seconds * 1000:.0f} ms, {len(last.spans)} spans')
+
+    spans = pd.DataFrame([{'page': trace.page, 'name': s['name'], 'seconds': s['seconds']}
+                          for trace in traces for s in trace.spans])
+    if not spans.empty:
+        slowest = (spans.groupby(['page', 'name'])['seconds']
+                   .agg(calls='count', total='sum', max='max')
+                   .sort_values('max', ascending=False).head(15).reset_index())
+        st.sidebar.dataframe(slowest, hide_index=True, use_container_width=True)
+
+    counters = {}
+    for trace in traces:
+        for name, value in trace.counters.items():
+            counters[name] = counters.get(name, 0) + value
+    if counters:
+        st.sidebar.dataframe(pd.Series(counters, name='session total').rename_axis('counter').reset_index(),
+                             hide_index=True, use_container_width=True)
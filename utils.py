@@ -1,15 +1,50 @@
 # Fetch the CSV file from S3
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from functools import partial
+from hashlib import blake2b
 from io import BytesIO, StringIO
 import streamlit as st
+import numpy as np
+import openpyxl
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_numeric_dtype
 from botocore.exceptions import NoCredentialsError, ClientError
 
+from categorizer import suggest_categories
+from charts import start_precompute_figures
+from jobs import JOB_QUERY_PARAM, job_owner, submit_job
+from output_store import MANIFEST_NAME, MANIFEST_UPDATE_ATTEMPTS, UNKNOWN_MONTH, append_output_data, find_duplicates, \
+    list_months, read_categorizer_index, read_parquet_from_s3, write_manifest, write_parquet_to_s3
+from query import explorer_filter, explorer_page_sql, explorerOptionsSql, explorerSortCol, export_csv, \
+    query_transactions
+from s3_cache import get_object_bytes
+from schema import DATE_FORMAT
+from storage import fetch_objects, put_objects
+from tenancy import tenant_cache, tenant_of
+from tracing import count, span, traced_submit
+
 BUCKET_NAME = 'wikomexpensetracker'
-FILE_KEY_BUDGET = 'shared/budget_2025.xlsx'
+BUDGET_SHEETS = ("Listes de recherche", "Détails budget")
 FILENAME_RBC_CHEQUE_STAGING = 'rbc_checking_5336995.csv'
 
 cleanedCol = ['Date', 'Name', 'Account', 'Type', 'Category',
               'Sub Category', 'Amount', 'Description', 'To Ignore']
+# Arrow schema of the parsed rows spooled during an import, the same for every chunk
+# (a chunk of whole dollar amounts parses to integers)
+parsedSchema = pa.schema([('Date', pa.string()), ('Name', pa.string()), ('Account', pa.string()),
+                          ('Type', pa.string()), ('Category', pa.string()), ('Sub Category', pa.string()),
+                          ('Amount', pa.float64()), ('Description', pa.string()), ('To Ignore', pa.bool_())])
 listRBCCol = ['Type de compte', 'Numéro du compte', "Date de l'opération", "Numéro du chèque",
               "Description 1", "Description 2", "CAD", "USD"]
 listNBCCol = ['Date', 'Description', "Categorie", "Debit",
@@ -20,8 +55,109 @@ listNBCColCredit = ['Date', 'Numero de Carte', "Description", "Categorie", "Debi
 listScotiaCol = ['Filtre', 'Date', 'Description',
                  'Sous-description', 'Type d’opération', 'Montant', 'Solde']
 
+# column names and separator of the exports of every account
+accountFormats = {
+    'RBC': (listRBCCol, ','),
+    'NBC Cheque': (listNBCCol, ';'),
+    'NBC Credit': (listNBCColCredit, ';'),
+    'Scotia': (listScotiaCol, ','),
+}
+
+# rows read at a time from an uploaded bank export
+CHUNK_SIZE = 50_000
+# first bytes of an .xlsx export (a zip archive)
+XLSX_SIGNATURE = b'PK\x03\x04'
+# processes parsing the uploaded exports
+PARSE_WORKERS = min(4, os.cpu_count() or 1)
+# page sizes of the categorization editor
+PAGE_SIZES = [25, 50, 100, 250]
+
+
+def parse_workbook_sheets(data, sheet_names):
+    """
+    Parse some sheets of an Excel workbook in a single read-only pass.
+
+    The first row of a sheet is its header, like pandas.read_excel.
+
+    Parameters:
+    data (bytes): The content of the workbook.
+    sheet_names (list): The names of the sheets to parse.
+
+    Returns:
+    dict: The DataFrame of every sheet.
+    """
+    workbook = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True)
+    try:
+        sheets = {}
+        for sheet_name in sheet_names:
+            rows = workbook[sheet_name].iter_rows(values_only=True)
+            header = list(next(rows, ()))
+            while header and header[-1] is None:
+                header.pop()
+            values = [row[:len(header)] for row in rows]
+            # drop the empty rows at the end of the sheet
+            while values and all(value is None for value in values[-1]):
+                values.pop()
+            columns = [name if name is not None else f'Unnamed: {i}' for i, name in enumerate(header)]
+            df = pd.DataFrame(values, columns=columns).infer_objects()
+            # missing cells are NaN, as with pandas.read_excel
+            sheets[sheet_name] = df.mask(df.isna(), np.nan)
+    finally:
+        workbook.close()
+    return sheets
+
+
+@tenant_cache('key_file_budget', version_arg='etag')
+def load_budget_workbook_version(_s3, bucket_name, key_file_budget, etag):
+    """
+    Load the sheets of a version of the budget workbook.
+
+    A Parquet snapshot of every sheet is kept next to the workbook for each version, so the
+    workbook is downloaded and parsed only once per version. The sheets are cached in the
+    memory budget of the tenant owning the workbook.
+
+    Parameters:
+    _s3 (boto3.client): The S3 client object (not hashed).
+    bucket_name (str): The name of the S3 bucket.
+    key_file_budget (str): The key (path) to the budget file in the S3 bucket.
+    etag (str): The ETag of the workbook version, part of the cache key.
+
+    Returns:
+    dict: The DataFrame of every sheet of BUDGET_SHEETS.
+    """
+    snapshot_prefix = key_file_budget + '.snapshot/' + etag.strip('"') + '/'
+    try:
+        return {sheet_name: read_parquet_from_s3(_s3, bucket_name, f"{snapshot_prefix}{sheet_name}.parquet")
+                for sheet_name in BUDGET_SHEETS}
+    except ClientError:
+        pass
+
+    data = get_object_bytes(_s3, bucket_name, key_file_budget)
+    sheets = parse_workbook_sheets(data, BUDGET_SHEETS)
+    try:
+        for sheet_name, df in sheets.items():
+            write_parquet_to_s3(df, _s3, bucket_name, f"{snapshot_prefix}{sheet_name}.parquet")
+    except (pa.ArrowException, NoCredentialsError) as e:
+        print(f"No snapshot for {bucket_name}/{key_file_budget}: {e}")
+    return sheets
+
+
+def load_budget_workbook(s3, bucket_name, key_file_budget):
+    """
+    Load the sheets of the current version of the budget workbook.
+
+    Parameters:
+    s3 (boto3.client): The S3 client object.
+    bucket_name (str): The name of the S3 bucket.
+    key_file_budget (str): The key (path) to the budget file in the S3 bucket.
+
+    Returns:
+    dict: The DataFrame of every sheet of BUDGET_SHEETS.
+    """
+    etag = s3.head_object(Bucket=bucket_name, Key=key_file_budget)['ETag']
+    return load_budget_workbook_version(s3, bucket_name, key_file_budget, etag)
+
 
-@st.cache_data
 def load_budget_sheet(_s3, bucket_name, key_file_budget, sheet_name):
     """
     Load a budget sheet from an S3 bucket.
@@ -30,15 +166,12 @@ def load_budget_sheet(_s3, bucket_name, key_file_budget, sheet_name):
     _s3 (boto3.client): The S3 client object.
     bucket_name (str): The name of the S3 bucket.
     key_file_budget (str): The key (path) to the budget file in the S3 bucket.
-    sheet_name (str): The name of the sheet within the Excel file to load.
+    sheet_name (str): The name of the sheet within the Excel file to load, one of BUDGET_SHEETS.
 
     Returns:
     pandas.DataFrame: The loaded budget sheet as a DataFrame.
     """
-    obj = _s3.get_object(Bucket=bucket_name, Key=key_file_budget)
-    data = obj['Body'].read()
-    df = pd.read_excel(BytesIO(data), sheet_name=sheet_name)
-    return df
+    return load_budget_workbook(_s3, bucket_name, key_file_budget)[sheet_name]
 
 
 def read_csv_from_s3(s3_client, bucket, file_key):
@@ -54,56 +187,86 @@ def read_csv_from_s3(s3_client, bucket, file_key):
     str: The content of the CSV file as a string.
     """
     try:
-        obj = s3_client.get_object(Bucket=bucket, Key=file_key)
+        data = get_object_bytes(s3_client, bucket, file_key)
     except ClientError as e:
         return None
 
-    data = obj['Body'].read().decode('utf-8')
-    return data
+    return data.decode('utf-8')
 
 
 def set_category(s3, bucket_name, file_key_budget):
-    df_cat = load_budget_sheet(
-        s3, bucket_name, file_key_budget, "Listes de recherche")
-    df_sub_cat = load_budget_sheet(
-        s3, bucket_name, file_key_budget, "Détails budget")
+    sheets = load_budget_workbook(s3, bucket_name, file_key_budget)
+    df_cat = sheets["Listes de recherche"]
+    df_sub_cat = sheets["Détails budget"]
     categories = df_cat['Recherche catégorie budget'].unique()
-    category_dict = {}
-    for category in categories:
-        sub_categories = df_sub_cat[df_sub_cat['Catégorie'] == category]['Description'].unique()
+    sub_categories = df_sub_cat.groupby('Catégorie', sort=False, dropna=False)['Description'].unique()
 
-        # Add a default sub category to all categories
-        sub_categories = [category + ' - Autre'] + list(sub_categories)
-        category_dict[category] = sub_categories
+    # Add a default sub category to all categories
+    category_dict = {category: [category + ' - Autre'] + list(sub_categories.get(category, []))
+                     for category in categories}
 
     return categories, category_dict
 
 
+def join_descriptions(first, second, sep=' / '):
+    """
+    Join two description columns, skipping the missing values.
+
+    Parameters:
+    first (pandas.Series): The first description.
+    second (pandas.Series): The second description.
+    sep (str): The separator used when both descriptions are set.
+
+    Returns:
+    pandas.Series: The joined descriptions, an empty string when both are missing.
+    """
+    has_first, has_second = first.notna(), second.notna()
+    first, second = first.astype(str), second.astype(str)
+    only_one = first.where(has_first, second.where(has_second, ''))
+    return (first + sep + second).where(has_first & has_second, only_one)
+
+
+def extract_amounts(data, columns):
+    """
+    Extract the numeric amount of several text columns in a single regex pass.
+
+    Parameters:
+    data (pandas.DataFrame): The raw data.
+    columns (list): The columns holding the amounts.
+
+    Returns:
+    numpy.ndarray: One row of floats per column.
+    """
+    stacked = pd.concat([data[col].astype(str) for col in columns], ignore_index=True)
+    amounts = stacked.str.extract(r'(\d+[.]?\d*)', expand=False).astype(float)
+    return amounts.to_numpy().reshape(len(columns), len(data))
+
+
 def parse_rbc_data(data):
     nb_col = data.shape[1]
     if nb_col != len(listRBCCol):
         return 101, pd.DataFrame()
     if 'Type de compte' in list(data.columns):
-        data['Type de compte'] = data['Type de compte'].astype(
-            str).replace(to_replace='Chèques', value='Checking')
-        data['Type de compte'] = data['Type de compte'].astype(
-            str).replace(to_replace='MasterCard', value='Credit Card')
+        data['Type de compte'] = data['Type de compte'].astype(str).replace(
+            {'Chèques': 'Checking', 'MasterCard': 'Credit Card'})
         data = data.rename(columns={'Type de compte': 'Account'})
 
     else:
         return 102, pd.DataFrame()
     if "Date de l'opération" in list(data.columns):
         data = data.rename(columns={"Date de l'opération": 'Date'})
-        #Date is in format mm/dd/yyyy. Set it to yyyy-mm-dd
-        data['Date'] = pd.to_datetime(data['Date'], format='%m/%d/%Y').dt.strftime('%Y-%m-%d')
+        #Date is in format mm/dd/yyyy (yyyy-mm-dd in .xlsx exports). Set it to yyyy-mm-dd
+        dates = pd.to_datetime(data['Date'], format='%m/%d/%Y', errors='coerce')
+        is_iso = dates.isna() & data['Date'].notna()
+        if is_iso.any():
+            dates[is_iso] = pd.to_datetime(data.loc[is_iso, 'Date'], format=DATE_FORMAT)
+        data['Date'] = dates.dt.strftime(DATE_FORMAT)
     else:
         return 102, pd.DataFrame()
 
     if 'Description 1' in list(data.columns) and 'Description 2' in list(data.columns):
-        # data['Description'] = data['Description 1'].astype(str) + ' / '+ data['Description 2'].astype(str)
         # Create a new column 'Description' based on the values of 'Description 1' and 'Description 2'
-        data['Description'] = data.apply(
-            lambda row: ' / '.join(filter(pd.notna, [row['Description 1'], row['Description 2']])), axis=1)
+        data['Description'] = join_descriptions(data['Description 1'], data['Description 2'])
     else:
         return 102, pd.DataFrame()
 
@@ -113,11 +276,10 @@ def parse_rbc_data(data):
         return 102, pd.DataFrame()
 
     # create new column type on the amount sign
-    data['Type'] = data['Amount'].apply(
-        lambda x: 'expense' if x < 0 else 'credit')
+    data['Type'] = np.where(data['Amount'] < 0, 'expense', 'credit')
 
     # Absolute value on amount
-    data['Amount'] = data['Amount'].abs()
+    data['Amount'] = data['Amount'].astype(float).abs()
 
     # Add reminding clean columns. Name is based on the file name, Category is set to "", and To Ignore is set to False
     data['Name'] = 'RBC'
@@ -129,30 +291,29 @@ def parse_rbc_data(data):
     return 100, data
 
 
-def parse_bnc_data(data):
+def parse_bnc_rows(data, list_col, account):
     nbCol = data.shape[1]
-    if nbCol != len(listNBCCol):
+    if nbCol != len(list_col):
         return 101, pd.DataFrame()
 
     if not 'Date' in list(data.columns):
         return 102, pd.DataFrame()
 
     if "Debit" in list(data.columns) and "Credit" in list(data.columns):
-        data['Debit'] = data['Debit'].astype(str).str.extract(r'(\d+[.]?\d*)', expand=True).astype(float)
-        data['Credit'] = data['Credit'].astype(str).str.extract(r'(\d+[.]?\d*)', expand=True).astype(float)
+        data['Debit'], data['Credit'] = extract_amounts(data, ['Debit', 'Credit'])
         data['Amount'] = data['Debit'] + data['Credit']
         # create new column type
-        data['Type'] = data['Debit'].apply(lambda x: 'expense' if x > 0 else 'credit')
+        data['Type'] = np.where(data['Debit'] > 0, 'expense', 'credit')
 
     else:
         return 102, pd.DataFrame()
 
     if 'Description' in list(data.columns) and 'Categorie' in list(data.columns):
-        data['Description'] = data['Description'].astype(str) + ' / '+ data['Categorie'].astype(str)
+        data['Description'] = data['Description'].astype(str) + ' / ' + data['Categorie'].astype(str)
     else:
         return 102, pd.DataFrame()
 
-    data['Account'] = 'Checking'
+    data['Account'] = account
 
     # Add reminding clean columns. Name is based on the file name, Category is set to "", and To Ignore is set to False
     data['Name'] = 'NBC'
@@ -165,40 +326,12 @@ def parse_bnc_data(data):
     return 100, data
 
 
-def parse_bnc_credit_data(data):
-    nbCol = data.shape[1]
-    if nbCol != len(listNBCColCredit):
-        return 101, pd.DataFrame()
-
-    if not 'Date' in list(data.columns):
-        return 102, pd.DataFrame()
-
-    if "Debit" in list(data.columns) and "Credit" in list(data.columns):
-        data['Debit'] = data['Debit'].astype(str).str.extract(r'(\d+[.]?\d*)', expand=True).astype(float)
-        data['Credit'] = data['Credit'].astype(str).str.extract(r'(\d+[.]?\d*)', expand=True).astype(float)
-        data['Amount'] = data['Debit'] + data['Credit']
-        # create new column type
-        data['Type'] = data['Debit'].apply(lambda x: 'expense' if x > 0 else 'credit')
-
-    else:
-        return 102, pd.DataFrame()
-
-    if 'Description' in list(data.columns) and 'Categorie' in list(data.columns):
-        data['Description'] = data['Description'].astype(str) + ' / ' + data['Categorie'].astype(str)
-    else:
-        return 102, pd.DataFrame()
-
-    data['Account'] = 'Credit Card'
-
-    # Add reminding clean columns. Name is based on the file name, Category is set to "", and To Ignore is set to False
-    data['Name'] = 'NBC'
-    data['Category'] = ''
-    data['Sub Category'] = ''
-    data['To Ignore'] = False
+def parse_bnc_data(data):
+    return parse_bnc_rows(data, listNBCCol, 'Checking')
 
-    data = data[cleanedCol]
 
-    return 100, data
+def parse_bnc_credit_data(data):
+    return parse_bnc_rows(data, listNBCColCredit, 'Credit Card')
 
 
 def parse_scotia_data(data, type_account):
@@ -213,7 +346,7 @@ def parse_scotia_data(data, type_account):
 
     if "Type d’opération" in list(data.columns):
         # create new column type
-        data['Type'] = data['Type d’opération'].apply(lambda x: 'expense' if x == 'Débit' else 'credit')
+        data['Type'] = np.where(data['Type d’opération'] == 'Débit', 'expense', 'credit')
 
     else:
         return 102, pd.DataFrame()
@@ -224,7 +357,6 @@ def parse_scotia_data(data, type_account):
         return 102, pd.DataFrame()
 
     if "Montant" in list(data.columns):
-        # create new column type
         data['Amount'] = data['Montant'].astype(float).abs()
 
     else:
@@ -242,121 +374,708 @@ def parse_scotia_data(data, type_account):
 
     return 100, data
 
-def update_category(df, index, category):
-    df.at[index, 'Category'] = category
+# parser of every account, to run in the parse pool
+accountParsers = {
+    'RBC': parse_rbc_data,
+    'NBC Cheque': parse_bnc_data,
+    'NBC Credit': parse_bnc_credit_data,
+    'Scotia': partial(parse_scotia_data, type_account='Checking'),
+}
+
+
+def is_xlsx(data):
+    return data[:len(XLSX_SIGNATURE)] == XLSX_SIGNATURE
+
+
+def xlsx_frame(rows, names):
+    # cells as pandas.read_csv reads them: dates written yyyy-mm-dd, missing cells NaN
+    df = pd.DataFrame(rows, columns=names).infer_objects()
+    for col in df.columns:
+        if is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime(DATE_FORMAT)
+        elif df[col].dtype == object:
+            df[col] = df[col].map(lambda value: value.strftime(DATE_FORMAT) if isinstance(value, datetime) else value)
+    return df.mask(df.isna(), np.nan)
 
 
-def update_sub_category(df, index, sub_category):
-    df.at[index, 'Sub Category'] = sub_category
+def read_xlsx_chunks(data, names, chunksize=CHUNK_SIZE):
+    """
+    Read the rows of an .xlsx bank export in chunks, streaming the workbook with openpyxl's
+    read-only mode: only the current chunk is held in memory, not the workbook.
+
+    The rows of every sheet are read, after its header row. Empty rows are skipped.
+
+    Parameters:
+    data (bytes): The content of the workbook.
+    names (list): The column names of the export.
+    chunksize (int): The number of rows of a chunk.
+
+    Returns:
+    generator: DataFrames of at most chunksize rows, like pandas.read_csv with chunksize.
+    """
+    workbook = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True)
+    try:
+        padding = (None,) * len(names)
+        rows = []
+        for worksheet in workbook.worksheets:
+            for row in worksheet.iter_rows(min_row=2, values_only=True):
+                if all(value is None for value in row):
+                    continue
+                rows.append((row + padding)[:len(names)])
+                if len(rows) == chunksize:
+                    yield xlsx_frame(rows, names)
+                    rows = []
+        if rows:
+            yield xlsx_frame(rows, names)
+    finally:
+        workbook.close()
+
+
+def read_xlsx_header(data):
+    """
+    Read the header row of the first sheet of an .xlsx export.
+
+    Returns:
+    list: The column names, None when the workbook can't be read.
+    """
+    try:
+        workbook = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True)
+    except Exception:
+        return None
+    try:
+        header = list(next(workbook.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+    finally:
+        workbook.close()
+    while header and header[-1] is None:
+        header.pop()
+    return ['' if name is None else str(name) for name in header]
+
+
+def read_export_chunks(data, account):
+    """
+    Read the rows of a bank export, .csv or .xlsx, in chunks of CHUNK_SIZE rows.
+
+    Parameters:
+    data (bytes): The content of the export.
+    account (str): The account of the export, giving its columns.
+
+    Returns:
+    iterable: DataFrames of the raw rows, named after the columns of the account.
+    """
+    list_col, sep = accountFormats[account]
+    if is_xlsx(data):
+        return read_xlsx_chunks(data, list_col)
+    return pd.read_csv(BytesIO(data), names=list_col, index_col=False, sep=sep, skiprows=1, chunksize=CHUNK_SIZE)
 
 
-def update_ignore(df, index, ignore):
-    df.at[index, 'To Ignore'] = ignore
+def detect_account(data):
+    """
+    Detect the account of a bank export (.csv or .xlsx) from its header line.
 
+    The header must have the columns (and separator) of exactly one account format. When
+    no format has the same column names, a unique format with the same number of columns
+    is accepted.
 
-def display_category_form(df, categories, category_dict, s3, file_key):
-    categories = [''] + list(categories)
+    Parameters:
+    data (bytes): The content of the export.
+
+    Returns:
+    str: The account, or None if it can't be detected.
+    """
+    xlsx_header = read_xlsx_header(data) if is_xlsx(data) else None
+    header = data.split(b'\n', 1)[0].decode('utf-8', errors='replace').lstrip('\ufeff').strip()
 
-    def create_table(row):
-        index = row.name
-        with st.container(border=True):
-            cols = st.columns((1, 2, 2, 2, 2, 2, 2, 2))
-            cols[0].write(f"{index + 1}")
-            cols[1].write(row['Date'])
-            cols[2].write(row['Amount'])
-            cols[3].write(row['Type'])
-            cols[4].write(row['Description'])
-            # onchange: set category in dataframe
-            category = cols[5].selectbox(
-                'Category', categories, key=f'category_{index}',
-                on_change=lambda: update_category(df, index, st.session_state[f'category_{index}']))
-            sub_category = cols[6].selectbox(
-                'Sub Category', category_dict[category] if category != "" else [], key=f'sub_category_{index}',
-                on_change=lambda: update_sub_category(df, index, st.session_state[f'sub_category_{index}']))
-            ignore = cols[7].checkbox('To Ignore', key=f'ignore_{index}',
-                                      on_change=lambda: update_ignore(df, index, st.session_state[f'ignore_{index}'])
-                                      )
+    def normalize(names):
+        return [name.strip().strip('"').strip().lower() for name in names]
 
-            return row
+    same_count = []
+    for account, (list_col, sep) in accountFormats.items():
+        names = xlsx_header if xlsx_header is not None else header.split(sep)
+        if normalize(names) == normalize(list_col):
+            return account
+        if len(names) == len(list_col):
+            same_count.append(account)
+    return same_count[0] if len(same_count) == 1 else None
 
-    df.apply(create_table, axis=1)
-    submit_button = st.button('Save transactions')
+
+@st.cache_resource
+def get_parse_pool():
+    # spawned workers, forking the threaded Streamlit server isn't safe
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+_parse_pool_lock = threading.Lock()
+
+
+def replace_parse_pool(broken_pool):
+    """
+    Replace a broken parse pool: a pool whose worker died (out of memory...) can't run
+    anything anymore. The pool is replaced once, whatever the number of imports finding it broken.
+
+    Returns:
+    concurrent.futures.ProcessPoolExecutor: The new parse pool.
+    """
+    with _parse_pool_lock:
+        if get_parse_pool() is broken_pool:
+            print("A worker of the parse pool died, starting a new pool")
+            broken_pool.shutdown(wait=False)
+            get_parse_pool.clear()
+        return get_parse_pool()
+
+
+def ingest_files(files, s3_client, bucket, staging_objects, progress=None):
+    """
+    Stage and parse several bank exports concurrently.
+
+    Every account is ingested in its own thread (the exports of an account share a staging
+    manifest, so they are ingested one after the other), and the chunks are hashed and
+    parsed in a process pool. The parsed rows of all the exports are merged in a single queue.
+
+    Parameters:
+    files (list): The (name, account, content) of every export.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    staging_objects (dict): The key of the staging object of every account.
+    progress (function): Called as progress(fraction, message) after every file.
+
+    Returns:
+    tuple: The import result of every file (name, account, return code, stats), the
+        parsed rows of the successful imports and the stats of the import (see ingest_chunks).
+    """
+    start = time.perf_counter()
+    pool = get_parse_pool()
+    nb_done = []
+    progress_lock = threading.Lock()
+    files_by_account = {}
+    for name, account, data in files:
+        files_by_account.setdefault(account, []).append((name, data))
+
+    def ingest_account(account, account_files):
+        parser = accountParsers[account]
+        results = []
+        for name, data in account_files:
+            chunks = read_export_chunks(data, account)
+            results.append((name, account) + ingest_chunks(
+                chunks, parser, s3_client, bucket, staging_objects[account], executor=pool))
+            if progress is not None:
+                with progress_lock:
+                    nb_done.append(name)
+                    progress(len(nb_done) / len(files), f'{name} imported')
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, len(files_by_account))) as executor:
+        futures = [traced_submit(executor, ingest_account, account, account_files)
+                   for account, account_files in files_by_account.items()]
+        results = [result for future in futures for result in future.result()]
+
+    parsed = [df for _, _, ret, df, _ in results if ret == 100]
+    queue = pd.concat(parsed, ignore_index=True) if parsed else pd.DataFrame(columns=cleanedCol)
+
+    # estimated: the accounts are imported concurrently, then the parsed rows are held twice by the merge
+    account_peaks = {}
+    for _, account, _, _, file_stats in results:
+        account_peaks[account] = max(account_peaks.get(account, 0), file_stats['peak_memory'])
+    peak_memory = max(sum(account_peaks.values()), 2 * frame_memory(queue))
+    stats = {'rows': len(queue), 'seconds': time.perf_counter() - start, 'peak_memory': peak_memory}
+    return [(name, account, ret, file_stats) for name, account, ret, _, file_stats in results], queue, stats
+
+
+def filter_transactions(df, text, types, only_uncategorized):
+    """
+    Filter the transactions shown in the categorization editor.
+
+    Parameters:
+    df (pandas.DataFrame): The transactions to categorize.
+    text (str): Text searched in the description, case insensitive.
+    types (list): The transaction types to keep. All types when empty.
+    only_uncategorized (bool): Keep only the transactions without a category.
+
+    Returns:
+    pandas.DataFrame: The matching transactions, with their original index.
+    """
+    mask = pd.Series(True, index=df.index)
+    if text:
+        mask &= df['Description'].astype(str).str.contains(text, case=False, regex=False)
+    if types:
+        mask &= df['Type'].isin(types)
+    if only_uncategorized:
+        mask &= (df['Category'].fillna('') == '') & ~df['To Ignore']
+    return df[mask]
+
+
+def apply_category_edits(df, edited, category_dict):
+    """
+    Apply the edits of the categorization editor to the transactions in one update.
+
+    Sub categories that don't belong to the selected category are cleared.
+
+    Parameters:
+    df (pandas.DataFrame): The transactions to categorize, updated in place.
+    edited (pandas.DataFrame): The edited rows, indexed like df.
+    category_dict (dict): The sub categories of every category, from set_category.
+
+    Returns:
+    int: The number of cleared sub categories.
+    """
+    edited = edited[['Category', 'Sub Category', 'To Ignore']].copy()
+    edited['Category'] = edited['Category'].fillna('')
+    edited['Sub Category'] = edited['Sub Category'].fillna('')
+    edited['To Ignore'] = edited['To Ignore'].fillna(False).astype(bool)
+
+    valid_pairs = {(category, sub_category)
+                   for category, sub_categories in category_dict.items() for sub_category in sub_categories}
+    pairs = pd.Series(list(zip(edited['Category'], edited['Sub Category'])), index=edited.index)
+    is_valid = pairs.isin(valid_pairs) | (edited['Sub Category'] == '')
+    edited.loc[~is_valid, 'Sub Category'] = ''
+
+    df.loc[edited.index, ['Category', 'Sub Category', 'To Ignore']] = edited
+    return int((~is_valid).sum())
+
+
+def display_category_form(df, categories, category_dict, s3, file_key, saving=False):
+    """
+    Display the categorization editor of the imported transactions, one page at a time,
+    and save them to the output store in a background job. The save is disabled while
+    a save job runs.
+    """
+    sub_categories = [sub_category for category in categories for sub_category in category_dict[category]]
+
+    # filters and pagination are evaluated here, only the current page is sent to the browser
+    cols = st.columns((3, 2, 2, 1, 1))
+    text = cols[0].text_input('Description contains', key='category_filter_text')
+    types = cols[1].multiselect('Type', ['expense', 'credit'], key='category_filter_types')
+    only_uncategorized = cols[2].checkbox('Only uncategorized', key='category_filter_uncategorized')
+    page_size = cols[3].selectbox('Rows per page', PAGE_SIZES, key='category_page_size')
+    df_filtered = filter_transactions(df, text, types, only_uncategorized)
+    nb_pages = max(1, -(-len(df_filtered) // page_size))
+    if st.session_state.get('category_page', 1) > nb_pages:
+        st.session_state['category_page'] = nb_pages
+    page = cols[4].number_input('Page', min_value=1, max_value=nb_pages, step=1, key='category_page')
+    st.caption(f"{len(df_filtered)} of {len(df)} transactions, page {page} of {nb_pages}")
+
+    df_page = df_filtered.iloc[(page - 1) * page_size:page * page_size]
+    read_only_cols = ['Date', 'Amount', 'Type', 'Description'] + [col for col in ['Confidence', 'Duplicate']
+                                                                   if col in df.columns]
+    with st.form(key='form_categories'):
+        edited = st.data_editor(
+            df_page[read_only_cols + ['Category', 'Sub Category', 'To Ignore']],
+            column_config={
+                'Confidence': st.column_config.ProgressColumn('Confidence', min_value=0, max_value=1, format='%.2f'),
+                'Duplicate': st.column_config.ProgressColumn('Duplicate', min_value=0, max_value=1, format='%.2f',
+                                                             help='Similarity with a saved transaction'),
+                'Category': st.column_config.SelectboxColumn('Category', options=list(categories)),
+                'Sub Category': st.column_config.SelectboxColumn('Sub Category', options=sub_categories),
+                'To Ignore': st.column_config.CheckboxColumn('To Ignore'),
+            },
+            disabled=read_only_cols,
+            use_container_width=True,
+            key=f'category_editor_{page}_{page_size}_{text}_{types}_{only_uncategorized}',
+        )
+        if st.form_submit_button('Apply changes'):
+            nb_cleared = apply_category_edits(df, edited, category_dict)
+            if nb_cleared:
+                st.warning(f'{nb_cleared} sub categories did not match their category and were cleared.')
+
+    submit_button = st.button('Save transactions', disabled=saving)
     if submit_button:
         # keep data with to ignore set to False
         df_to_keep = df[df['To Ignore'] == False]
         # check that all categories are set and subcategories are set
-        # use filter to check empty string for category and subcategory
-        if df_to_keep[['Category', 'Sub Category']].map(lambda x: x == '' or x is None).any().any():
+        is_missing = (df_to_keep[['Category', 'Sub Category']].fillna('') == '').any(axis=1)
+        if is_missing.any():
             st.warning('Please categorize all transactions before saving.')
             # display the dataframe with the missing categories
-            st.write(df_to_keep[df_to_keep['Category'] is None or df_to_keep['Sub Category'] is None])
+            st.write(df_to_keep[is_missing])
         else:
-            # remove columns to ignore
-            df_to_keep = df_to_keep.drop(columns=['To Ignore'])
-            st.write('Saving transactions...')
-            append_output_data(df_to_keep, s3, BUCKET_NAME, file_key)
-            st.write('Transactions saved successfully.')
-            st.session_state.form_data = None
-            # do like a f5 update
+            # saved in the background, the page polls the job
+            st.query_params[JOB_QUERY_PARAM] = submit_job(tenant_of(file_key), job_owner(), 'save',
+                                                          save_transactions, df_to_keep, s3, BUCKET_NAME, file_key)
             st.rerun()
 
 
+def save_transactions(progress, df, s3_client, bucket, file_key):
+    """
+    Save categorized transactions to the output store, as a background job (see jobs.py).
+
+    Transactions saved by another session since the import, and not flagged as duplicates
+    then, are not saved: the save stops so they can be reviewed.
+
+    Parameters:
+    progress (function): Reports the progress of the job.
+    df (pandas.DataFrame): The transactions to save, in the cleanedCol layout.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    file_key (str): The prefix of the output store, ending with '/'.
+
+    Returns:
+    dict: 'saved', the number of saved transactions, and 'duplicates', the similarity of
+        the new suspected duplicates with the saved transactions (empty when saved).
+
+    Raises:
+    ValueError: Some transactions are invalid (see schema.validate_transactions).
+    """
+    progress(0.1, 'Checking duplicates')
+    duplicates = find_duplicates(df, s3_client, bucket, file_key)
+    reviewed = df['Duplicate'] > 0 if 'Duplicate' in df.columns else pd.Series(False, index=df.index)
+    new_duplicates = duplicates[(duplicates > 0) & ~reviewed]
+    if not new_duplicates.empty:
+        return {'saved': 0, 'duplicates': new_duplicates}
+
+    progress(0.3, f'Saving {len(df)} transactions')
+    append_output_data(df.drop(columns=['To Ignore']), s3_client, bucket, file_key)
+    progress(0.9, 'Building the charts')
+    # build the charts of the recent months of the new version before they are shown
+    start_precompute_figures(s3_client, bucket, file_key)
+    return {'saved': len(df), 'duplicates': new_duplicates}
+
+
+def ingest_transactions(progress, files, s3_client, bucket, staging_objects, category_dict, output_prefix):
+    """
+    Import bank exports, as a background job (see jobs.py): stage and parse them, pre-fill
+    the categories from the history and flag the transactions already saved.
+
+    Parameters:
+    progress (function): Reports the progress of the job.
+    files (list): The (name, account, content) of every export.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    staging_objects (dict): The key of the staging object of every account.
+    category_dict (dict): The sub categories of every category, from set_category.
+    output_prefix (str): The prefix of the output store, ending with '/'.
+
+    Returns:
+    dict: 'results', the import result of every file (name, account, return code, stats),
+        'stats', the stats of the import, and 'data', the parsed transactions to categorize.
+    """
+    results, parsed_data, stats = ingest_files(
+        files, s3_client, bucket, staging_objects,
+        progress=lambda fraction, message: progress(0.8 * fraction, message))
+    if not parsed_data.empty:
+        progress(0.8, 'Categorizing')
+        # pre-fill the categories from the transaction history
+        categorizer_index = read_categorizer_index(s3_client, bucket, output_prefix)
+        parsed_data = suggest_categories(parsed_data, categorizer_index, category_dict)
+        progress(0.9, 'Checking duplicates')
+        # flag the transactions already saved (overlapping statements), ignored unless unchecked
+        parsed_data['Duplicate'] = find_duplicates(parsed_data, s3_client, bucket, output_prefix)
+        parsed_data.loc[parsed_data['Duplicate'] > 0, 'To Ignore'] = True
+    return {'results': results, 'stats': stats, 'data': parsed_data}
+
+
+def display_transactions_explorer(s3, bucket_name, prefix, manifest):
+    """
+    Display the consolidated transactions with period, account, category and text filters
+    and sorting. Filters, sorting and pagination run as queries on the server, only the
+    current page is sent to the browser. The CSV export of the filtered transactions is
+    built on demand.
+    """
+    def query(sql, params=(), months=None):
+        count('queries')
+        with span('query'):
+            return query_transactions(s3, bucket_name, prefix, manifest, manifest['version'], sql, params, months)
+
+    months = [month for month in list_months(manifest) if month != UNKNOWN_MONTH]
+    if not months:
+        st.info('No dated transactions.')
+        return
+    first, last = pd.Period(months[0]).start_time.date(), pd.Period(months[-1]).end_time.date()
+    options = query(explorerOptionsSql)
+
+    cols = st.columns((2, 2, 2, 3))
+    period = cols[0].date_input('Period', (first, last), min_value=first, max_value=last, key='explorer_period')
+    accounts = cols[1].multiselect('Account', sorted(options['Account'].dropna().unique()), key='explorer_accounts')
+    categories = cols[2].multiselect('Category', sorted(options['Category'].dropna().unique()),
+                                     key='explorer_categories')
+    text = cols[3].text_input('Description contains', key='explorer_text')
+    if len(period) != 2:
+        st.info('Select the last day of the period.')
+        return
+
+    cols = st.columns((2, 1, 1, 1))
+    sort_col = cols[0].selectbox('Sort by', explorerSortCol, key='explorer_sort')
+    descending = cols[1].toggle('Descending', value=True, key='explorer_descending')
+    page_size = cols[2].selectbox('Rows per page', PAGE_SIZES, key='explorer_page_size')
+
+    # only the months of the period are scanned
+    where, params = explorer_filter(period[0], period[1], accounts, categories, text)
+    period_months = tuple(month for month in months
+                          if period[0].strftime('%Y-%m') <= month <= period[1].strftime('%Y-%m'))
+    nb_rows = int(query(f'SELECT COUNT(*) AS n FROM transactions {where}', params, period_months)['n'].iloc[0])
+    nb_pages = max(1, -(-nb_rows // page_size))
+    if st.session_state.get('explorer_page', 1) > nb_pages:
+        st.session_state['explorer_page'] = nb_pages
+    page = cols[3].number_input('Page', min_value=1, max_value=nb_pages, step=1, key='explorer_page')
+    st.caption(f"{nb_rows} transactions, page {page} of {nb_pages}")
+    st.dataframe(query(explorer_page_sql(where, sort_col, descending, page_size, page), params, period_months),
+                 hide_index=True, use_container_width=True)
+
+    export_key = (manifest['version'], where, params)
+    if st.button('Prepare CSV export'):
+        st.session_state['explorer_export'] = (export_key, export_csv(s3, bucket_name, manifest, where, params,
+                                                                      period_months))
+    export = st.session_state.get('explorer_export')
+    if export is not None and export[0] == export_key:
+        st.download_button('Download CSV', export[1], file_name='transactions.csv', mime='text/csv')
+
+
+def hash_rows(df):
+    """
+    Compute a content hash for every row of a raw bank export.
+
+    Values are normalized (numbers as floats, missing values as empty strings, surrounding
+    spaces removed) so that a row hashes the same whether it comes from an upload or from
+    a staged CSV.
+
+    Parameters:
+    df (pandas.DataFrame): The raw rows.
+
+    Returns:
+    list: One hex digest per row.
+    """
+    if df.empty:
+        return []
+    df = df.apply(lambda col: col.astype(float) if is_numeric_dtype(col) and not is_bool_dtype(col) else col)
+    normalized = df.astype(object).where(df.notna(), '').astype(str)
+    joined = normalized.iloc[:, 0].str.strip()
+    for col in normalized.columns[1:]:
+        joined = joined + '\x1f' + normalized[col].str.strip()
+    return [blake2b(row.encode('utf-8'), digest_size=16).hexdigest() for row in joined]
+
+
+def staging_prefix(object_name):
+    # the segments, hash files and manifest of a staging object
+    return object_name.rsplit('.', 1)[0] + '/'
+
+
+def read_staging_manifest(s3_client, bucket, object_name):
+    """
+    Read the manifest of a staging object, with its ETag. The manifest lists the immutable
+    segments holding the staged rows, and the immutable hash files holding the content hash
+    of the rows of every segment.
+
+    A legacy single-file staging object is hashed once and becomes the first segment. The
+    hashes of a legacy single-file object, or of a manifest written before the hash files,
+    are in its 'hashes' list until the manifest is next written.
 
-def stage_data(df_new_data, s3_client, bucket, object_name):
+    Returns:
+    tuple: The manifest and its ETag, None when the staging object has no manifest yet.
+    """
     try:
-        # Check if the object exists
-        s3_client.head_object(Bucket=bucket, Key=object_name)
-        file_exists = True
+        obj = s3_client.get_object(Bucket=bucket, Key=staging_prefix(object_name) + MANIFEST_NAME)
+        manifest, etag = json.loads(obj['Body'].read().decode('utf-8')), obj['ETag']
     except ClientError:
-        file_exists = False
-
-    if file_exists:
         body_staging = read_csv_from_s3(s3_client, bucket, object_name)
-        df_staging = pd.read_csv(StringIO(body_staging), index_col=False)
+        if body_staging is None:
+            manifest = {'segments': []}
+        else:
+            df_staging = pd.read_csv(StringIO(body_staging), index_col=False)
+            manifest = {'segments': [object_name], 'hashes': hash_rows(df_staging)}
+        etag = None
+    manifest.setdefault('hash_files', [])
+    manifest.setdefault('hashes', [])
+    return manifest, etag
 
-        # Append df_new_data to df_staging
-        df_staging = pd.concat([df_staging, df_new_data], ignore_index=True)
 
-        # remove duplicates
-        df_staging = df_staging.drop_duplicates()
+def read_staged_hashes(s3_client, bucket, manifest):
+    """
+    Get the hashes of the staged rows. The hash files are immutable: after the first import,
+    only the hash files of the segments staged since are downloaded.
 
-        # create csv buffer
-        csv_buffer = df_staging.to_csv(index=False)
-    else:
-        csv_buffer = df_new_data.to_csv(index=False)
+    Returns:
+    set: The hashes.
+    """
+    hashes = set(manifest['hashes'])
+    for data in fetch_objects(s3_client, bucket, manifest['hash_files'], immutable=True).values():
+        hashes.update(data.decode('ascii').split())
+    return hashes
+
+
+def stage_segment(df_new_data, s3_client, bucket, object_name, staged, known_hashes, hashes=None):
+    """
+    Write the rows of df_new_data not staged yet as a new staging segment, with the hash
+    file of its rows.
+
+    Parameters:
+    df_new_data (pandas.DataFrame): The raw rows.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    object_name (str): The key of the staging object.
+    staged (dict): The 'segments' and 'hash_files' staged by the import, updated in place.
+    known_hashes (set): The hashes of the staged rows, updated in place.
+    hashes (list): The hashes of the rows of df_new_data, computed when None.
+
+    Returns:
+    int: The number of newly staged rows.
+    """
+    if hashes is None:
+        hashes = hash_rows(df_new_data)
+    # keep the first occurrence of the rows not staged yet
+    new_hashes = pd.Series(hashes, index=df_new_data.index, dtype=object)
+    is_new = ~new_hashes.isin(known_hashes) & ~new_hashes.duplicated()
+    if not is_new.any():
+        return 0
+
+    segment_name = (staging_prefix(object_name)
+                    + f"segment-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}")
+    put_objects(s3_client, bucket, {
+        segment_name + '.csv': df_new_data[is_new].to_csv(index=False).encode('utf-8'),
+        segment_name + '.hashes': '\n'.join(new_hashes[is_new]).encode('ascii'),
+    })
+    staged['segments'].append(segment_name + '.csv')
+    staged['hash_files'].append(segment_name + '.hashes')
+    known_hashes.update(new_hashes[is_new])
+    print(f"DataFrame uploaded to {bucket}/{segment_name}.csv")
+    return int(is_new.sum())
+
+
+def write_staging_manifest(s3_client, bucket, object_name, manifest, etag, staged):
+    """
+    Add the segments staged by an import to the staging manifest, with a conditional write
+    retried on the latest manifest when another import updated it in the meantime.
+
+    Parameters:
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    object_name (str): The key of the staging object.
+    manifest (dict): The manifest read before the import.
+    etag (str): The ETag of the manifest, None when there was none.
+    staged (dict): The 'segments' and 'hash_files' staged by the import (see stage_segment).
+
+    Raises:
+    RuntimeError: The manifest kept changing.
+    """
+    prefix = staging_prefix(object_name)
+    for attempt in range(MANIFEST_UPDATE_ATTEMPTS):
+        hash_files = list(manifest['hash_files'])
+        if manifest['hashes']:
+            # hashes listed in the manifest (legacy staging) move to a hash file of their own
+            legacy_key = f"{prefix}hashes-{uuid.uuid4().hex}.hashes"
+            s3_client.put_object(Bucket=bucket, Key=legacy_key, Body='\n'.join(manifest['hashes']).encode('ascii'))
+            hash_files.append(legacy_key)
+        updated = {'segments': manifest['segments'] + staged['segments'],
+                   'hash_files': hash_files + staged['hash_files']}
+        if write_manifest(s3_client, bucket, prefix, updated, etag):
+            return
+        time.sleep(0.05 * (attempt + 1))
+        manifest, etag = read_staging_manifest(s3_client, bucket, object_name)
+    raise RuntimeError(f"Can't update {bucket}/{prefix}{MANIFEST_NAME}, too many concurrent imports")
+
+
+def frame_memory(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def read_rss(field):
+    # resident memory of the process (VmRSS, or its peak VmHWM) in bytes, None without /proc
     try:
-        # Upload the CSV to S3
-        s3_client.put_object(Bucket=bucket, Key=object_name, Body=csv_buffer)
-        print(f"DataFrame uploaded to {bucket}/{object_name}")
-    except NoCredentialsError:
-        print("Credentials not available")
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
 
 
-def append_output_data(df_new_data, s3_client, bucket, object_name):
+def reset_peak_rss():
+    # restart the peak resident memory of the process from the current one (Linux)
     try:
-        # Check if the object exists
-        s3_client.head_object(Bucket=bucket, Key=object_name)
-        file_exists = True
-    except ClientError:
-        file_exists = False
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return read_rss('VmRSS')
 
-    if file_exists:
-        body_output = read_csv_from_s3(s3_client,bucket, object_name)
-        df_output = pd.read_csv(StringIO(body_output), index_col=False)
 
-        # Append df_new_data to df_output
-        df_output = pd.concat([df_output, df_new_data], ignore_index=True)
+def hash_and_parse(parser, chunk):
+    """
+    Hash the raw rows of a chunk for staging, and parse them. This is the CPU bound part
+    of an import, run in the parse pool.
 
-        # remove duplicates -- Not sure i need to do this
-        df_output = df_output.drop_duplicates()
+    The memory used by the parsing is the growth of the peak RSS of the worker process, which
+    parses one chunk at a time. It is 0 when run in the server process, whose memory is shared
+    with the other sessions, and where /proc is not available.
 
-        # create csv buffer
-        csv_buffer = df_output.to_csv(index=False)
-    else:
-        csv_buffer = df_new_data.to_csv(index=False)
-    try:
-        # Upload the CSV to S3
-        s3_client.put_object(Bucket=bucket, Key=object_name, Body=csv_buffer)
-        print(f"DataFrame uploaded to {bucket}/{object_name}")
-    except NoCredentialsError:
-        print("Credentials not available")
+    Returns:
+    tuple: The hashes of the rows, the parser result and the memory used by the parsing in bytes.
+    """
+    start_rss = reset_peak_rss() if multiprocessing.parent_process() is not None else None
+    hashes, result = hash_rows(chunk), parser(chunk.copy())
+    peak_rss = read_rss('VmHWM') if start_rss is not None else None
+    return hashes, result, max(0, peak_rss - start_rss) if peak_rss is not None else 0
+
+
+def ingest_chunks(chunks, parser, s3_client, bucket, object_name, executor=None):
+    """
+    Stage and parse a bank export one chunk at a time.
+
+    Each raw chunk is staged and parsed, and the parsed rows are spooled to a local
+    Parquet file, so only one raw chunk is held in memory at a time.
+
+    Parameters:
+    chunks (iterable): The raw rows, as DataFrames of at most CHUNK_SIZE rows.
+    parser (function): The parse_*_data function of the account, taking a raw DataFrame.
+    s3_client (boto3.client): The S3 client object.
+    bucket (str): The name of the S3 bucket.
+    object_name (str): The key of the staging object.
+    executor (concurrent.futures.Executor): Runs the hashing and parsing of the chunks,
+        in the calling thread when None. A broken pool is replaced by a new parse pool
+        (see replace_parse_pool), and the chunk parsed again once.
+
+    Returns:
+    tuple: The parser return code, the parsed rows and the import stats (rows, staged
+        rows, seconds, estimated peak memory in bytes). The peak memory is estimated for this
+        import only, from the size of the chunks and the memory used by their parsing (see
+        hash_and_parse), without tracing the memory of the whole process.
+    """
+    start = time.perf_counter()
+    peak_memory = 0
+    manifest, etag = read_staging_manifest(s3_client, bucket, object_name)
+    known_hashes = read_staged_hashes(s3_client, bucket, manifest)
+    staged = {'segments': [], 'hash_files': []}
+    ret, nb_rows, nb_staged = 100, 0, 0
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool_path = os.path.join(spool_dir, 'pending.parquet')
+        writer = None
+        try:
+            for chunk in chunks:
+                with span('parse', rows=len(chunk), object=object_name):
+                    if executor is None:
+                        hashes, (ret, parsed), parse_memory = hash_and_parse(parser, chunk)
+                    else:
+                        try:
+                            hashes, (ret, parsed), parse_memory = executor.submit(hash_and_parse, parser,
+                                                                                  chunk).result()
+                        except BrokenProcessPool:
+                            # a second failure fails the import, the next one replaces the pool again
+                            executor = replace_parse_pool(executor)
+                            hashes, (ret, parsed), parse_memory = executor.submit(hash_and_parse, parser,
+                                                                                  chunk).result()
+                # the raw chunk, and its parsing or at least the parsed rows
+                peak_memory = max(peak_memory, frame_memory(chunk) + max(parse_memory, frame_memory(parsed)))
+                with span('stage', object=object_name):
+                    nb_staged += stage_segment(chunk, s3_client, bucket, object_name, staged, known_hashes,
+                                               hashes)
+                if ret != 100:
+                    break
+                table = pa.Table.from_pandas(parsed, schema=parsedSchema, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(spool_path, parsedSchema)
+                writer.write_table(table)
+                nb_rows += len(parsed)
+        finally:
+            if writer is not None:
+                writer.close()
+            if nb_staged:
+                write_staging_manifest(s3_client, bucket, object_name, manifest, etag, staged)
+
+        if ret != 100:
+            parsed = pd.DataFrame()
+        elif writer is None:
+            parsed = pd.DataFrame(columns=cleanedCol)
+        else:
+            parsed = pd.read_parquet(spool_path)
+            peak_memory = max(peak_memory, frame_memory(parsed))
+
+    return ret, parsed, {'rows': nb_rows, 'staged': nb_staged,
+                         'seconds': time.perf_counter() - start, 'peak_memory': peak_memory}
@@ -0,0 +1,95 @@
+# Budget vs actual variance of the expenses
+import os
+
+import pandas as pd
+
+# column of the "Détails budget" sheet holding the budgeted amount, and the number of months
+# it covers (12 for an annual amount)
+BUDGET_AMOUNT_COL = os.environ.get('BUDGET_AMOUNT_COL', 'Mensuel')
+BUDGET_AMOUNT_MONTHS = int(os.environ.get('BUDGET_AMOUNT_MONTHS', 1))
+lineKeys = ['Category', 'Sub Category']
+
+
+def budget_lines(df_budget):
+    """
+    Extract the monthly budget of every line of the "Détails budget" sheet.
+
+    The amount is read from the BUDGET_AMOUNT_COL column, covering BUDGET_AMOUNT_MONTHS months.
+
+    Parameters:
+    df_budget (pandas.DataFrame): The "Détails budget" sheet.
+
+    Returns:
+    pandas.DataFrame: Category, Sub Category and Budget (monthly) of every line.
+
+    Raises:
+    ValueError: If the sheet has no BUDGET_AMOUNT_COL column.
+    """
+    if BUDGET_AMOUNT_COL not in df_budget.columns:
+        raise ValueError(f"No {BUDGET_AMOUNT_COL!r} column in the budget sheet, set BUDGET_AMOUNT_COL "
+                         f"to the column of the budgeted amounts")
+    amounts = pd.to_numeric(df_budget[BUDGET_AMOUNT_COL], errors='coerce') / BUDGET_AMOUNT_MONTHS
+
+    lines = pd.DataFrame({'Category': df_budget['Catégorie'], 'Sub Category': df_budget['Description'],
+                          'Budget': amounts.fillna(0).abs()})
+    lines = lines.dropna(subset=lineKeys)
+    return lines.groupby(lineKeys, as_index=False)['Budget'].sum()
+
+
+def compute_variance(df_budget, month_sub_category, year):
+    """
+    Compute the budget vs actual expenses of every budget line and every month of a year.
+
+    Actual expenses come from the month x category x sub category rollup maintained at
+    save time. Lines with expenses but no budget (like '<category> - Autre') get a zero
+    budget. Variance is budget minus actual: positive when under budget.
+
+    Parameters:
+    df_budget (pandas.DataFrame): The "Détails budget" sheet.
+    month_sub_category (pandas.DataFrame): The month_sub_category rollup of the output store.
+    year (str): The year (yyyy).
+
+    Returns:
+    pandas.DataFrame: Category, Sub Category, Month, Budget, Actual, Variance and the
+        year-to-date YTD Budget, YTD Actual and YTD Variance.
+
+    Raises:
+    ValueError: If the sheet has no budget amount column (see budget_lines).
+    """
+    months = [f"{year}-{month:02d}" for month in range(1, 13)]
+    actual = month_sub_category[(month_sub_category['Type'] == 'expense')
+                                & month_sub_category['Month'].isin(months)]
+    actual = actual.groupby(lineKeys + ['Month'], as_index=False)['Amount'].sum()
+    lines = budget_lines(df_budget)
+
+    # shared categorical keys, so the merges join on integer codes
+    keys = {}
+    for col in lineKeys:
+        keys[col] = pd.CategoricalDtype(pd.concat([lines[col], actual[col]]).astype(str).unique())
+        lines[col] = lines[col].astype(str).astype(keys[col])
+        actual[col] = actual[col].astype(str).astype(keys[col])
+    actual['Month'] = actual['Month'].astype(pd.CategoricalDtype(months, ordered=True))
+
+    all_lines = pd.concat([lines[lineKeys], actual[lineKeys]]).drop_duplicates()
+    grid = all_lines.merge(pd.DataFrame({'Month': actual['Month'].cat.categories}).astype(actual['Month'].dtype),
+                           how='cross')
+    variance = (grid.merge(lines, on=lineKeys, how='left')
+                .merge(actual, on=lineKeys + ['Month'], how='left')
+                .rename(columns={'Amount': 'Actual'}))
+    variance[['Budget', 'Actual']] = variance[['Budget', 'Actual']].fillna(0)
+    variance = variance.sort_values(lineKeys + ['Month'], ignore_index=True)
+
+    variance['Variance'] = variance['Budget'] - variance['Actual']
+    ytd = variance.groupby(lineKeys, observed=True)[['Budget', 'Actual']].cumsum()
+    variance['YTD Budget'] = ytd['Budget']
+    variance['YTD Actual'] = ytd['Actual']
+    variance['YTD Variance'] = variance['YTD Budget'] - variance['YTD Actual']
+    return variance
+
+
+def category_variance(variance):
+    """
+    Sum the variance of the budget lines by category and month.
+    """
+    return variance.groupby(['Category', 'Month'], observed=True, as_index=False)[
+        ['Budget', 'Actual', 'Variance', 'YTD Budget', 'YTD Actual', 'YTD Variance']].sum()